@@ -11,6 +11,11 @@ usage: %prog [options]
 import lx, tb
 import optparse, re, sys
 
+try:
+    import numpy
+except ImportError:             # only needed for --boundary-arrays
+    numpy = None
+
 
 def tree_string(tree, word_rex, ignore_terminal_rex):
 
@@ -48,8 +53,44 @@ def words_stringpos(ws):
         stringpos.add((left,right))
         left = right
     return stringpos
+
+# BoundaryArrays packs (utterance, left, right) and (utterance, left) into
+# single int64 keys; these are the field widths used for that
+_span_bits = 20
+_utt_shift = 2*_span_bits
+
+class BoundaryArrays:
+    """Encodes the segmentation of a whole sample as flat NumPy arrays.
+
+    The words of utterance u are lefts[offsets[u]:offsets[u+1]] (and
+    likewise for rights), where lefts and rights are string positions
+    within the utterance.  spankeys and boundarykeys are sorted int64
+    arrays holding the same information as words_stringpos() and
+    stringpos_boundarypos(), so comparing two samples of the same
+    corpus reduces to a sorted-array intersection."""
+
+    def __init__(self, words):
+        nwords = [len(ws) for ws in words]
+        lengths = numpy.array([len(w) for ws in words for w in ws], dtype=numpy.int64)
+        self.nutts = len(words)
+        self.offsets = numpy.zeros(self.nutts+1, dtype=numpy.int64)
+        self.offsets[1:] = numpy.cumsum(nwords)
+        self.utts = numpy.repeat(numpy.arange(self.nutts, dtype=numpy.int64), nwords)
+        uttlengths = numpy.bincount(self.utts, weights=lengths, minlength=self.nutts).astype(numpy.int64)
+        starts = numpy.cumsum(lengths) - lengths
+        self.lefts = starts - (numpy.cumsum(uttlengths) - uttlengths)[self.utts]
+        self.rights = self.lefts + lengths
+        self.spankeys = (self.utts << _utt_shift) | (self.lefts << _span_bits) | self.rights
+        internal = self.lefts > 0
+        self.boundarykeys = (self.utts[internal] << _span_bits) | self.lefts[internal]
+
+    def stringpos(self):
+        """Returns the segmentation as a list of sets of (left,right) pairs,
+        as produced by words_stringpos()"""
+        return [set(zip(self.lefts[b:e].tolist(), self.rights[b:e].tolist()))
+                for b,e in zip(self.offsets[:-1], self.offsets[1:])]
     
-def read_data(lines, tree_flag, score_cat_rex=None, ignore_terminal_rex=None, word_split_rex=None, debug_level=0):
+def read_data(lines, tree_flag, score_cat_rex=None, ignore_terminal_rex=None, word_split_rex=None, debug_level=0, array_flag=False, stream_flag=False):
     "Reads data either in tree format or in flat format"
 
     if tree_flag:
@@ -57,24 +98,38 @@ def read_data(lines, tree_flag, score_cat_rex=None, ignore_terminal_rex=None, wo
         for line in lines:
 	    #if line.count("lexentry")>0:
              #   continue
-            trees = tb.string_trees(line)
-            trees.insert(0, 'ROOT')
-            words.append(tree_string(trees, score_cat_rex, ignore_terminal_rex))
+            if stream_flag:
+                words.append(tb.string_words(line, score_cat_rex, ignore_terminal_rex))
+            else:
+                trees = tb.string_trees(line)
+                trees.insert(0, 'ROOT')
+                words.append(tree_string(trees, score_cat_rex, ignore_terminal_rex))
             if debug_level >= 1000:
                 sys.stderr.write("# line = %s,\n# words = %s\n"%(line, words[-1]))
     else:
         words = [[w for w in word_split_rex.split(line) if w != '' and not ignore_terminal_rex.match(w)] for line in lines]
 	#words = [[w for w in word_split_rex.split(line) if w != '' and not ignore_terminal_rex.match(w)] for line in lines if line.count("lexentry")==0]
-    segments = [''.join(ws) for ws in words]
     if debug_level >= 10000:
         sys.stderr.write("lines[0] = %s\n"%lines[0])
+    return words_data(words, debug_level, array_flag)
+
+def words_data(words, debug_level=0, array_flag=False):
+    "Maps a list of segmented utterances to their segments and string positions"
+
+    segments = [''.join(ws) for ws in words]
+    if debug_level >= 10000:
         sys.stderr.write("words[0] = %s\n"%words[0])
         sys.stderr.write("segments[0] = %s\n"%segments[0])
-    stringpos = [words_stringpos(ws) for ws in words]
+    if array_flag:
+        stringpos = BoundaryArrays(words)
+    else:
+        stringpos = [words_stringpos(ws) for ws in words]
     return (segments,stringpos)
 
 PrecRecHeader = "# f-score precision recall exact-match";
 
+EvalHeader = "token_f-score\ttoken_precision\ttoken_recall\tboundary_f-score\tboundary_precision\tboundary_recall\n"
+
 class PrecRec:
     def __init__(self):
         self.test = 0
@@ -111,15 +166,42 @@ def data_precrec(trainwords, goldwords):
         pr.update(t, g)
     return pr
 
+def keys_precrec(testkeys, goldkeys, utt_shift, nutts):
+    """Returns the PrecRec of two sorted key arrays from BoundaryArrays,
+    where key >> utt_shift is the utterance that key belongs to"""
+    correctkeys = numpy.intersect1d(testkeys, goldkeys, assume_unique=True)
+    ntest = numpy.bincount(testkeys >> utt_shift, minlength=nutts)
+    ngold = numpy.bincount(goldkeys >> utt_shift, minlength=nutts)
+    ncorrect = numpy.bincount(correctkeys >> utt_shift, minlength=nutts)
+    pr = PrecRec()
+    pr.n = nutts
+    pr.n_exactmatch = int(numpy.sum((ntest == ngold) & (ncorrect == ngold)))
+    pr.test = len(testkeys)
+    pr.gold = len(goldkeys)
+    pr.correct = len(correctkeys)
+    return pr
+
+def arrays_precrec(trainarrays, goldarrays):
+    """Returns the token and boundary PrecRecs of two BoundaryArrays"""
+    if trainarrays.nutts != goldarrays.nutts:
+        sys.stderr.write("## ** len(trainwords) = %s, len(goldwords) = %s\n" % (trainarrays.nutts, goldarrays.nutts))
+        sys.exit(1)
+    return (keys_precrec(trainarrays.spankeys, goldarrays.spankeys, _utt_shift, goldarrays.nutts),
+            keys_precrec(trainarrays.boundarykeys, goldarrays.boundarykeys, _span_bits, goldarrays.nutts))
+
 def stringpos_boundarypos(stringpos):
     return [set(left for left,right in line
                 if left > 0)
             for line in stringpos]
 
-def evaluate(options, trainwords, trainstringpos, goldwords, goldstringpos):
+def evaluate(options, trainwords, trainstringpos, goldwords, goldstringpos, outf=sys.stdout):
     
     if options.debug >= 1000:
-        for (tw, tsps, gw, gsps) in zip(trainwords, trainstringpos, goldwords, goldstringpos):
+        if options.array_flag:
+            trainsps, goldsps = trainstringpos.stringpos(), goldstringpos.stringpos()
+        else:
+            trainsps, goldsps = trainstringpos, goldstringpos
+        for (tw, tsps, gw, gsps) in zip(trainwords, trainsps, goldwords, goldsps):
             sys.stderr.write("Gold: ")
             for l,r in sorted(list(gsps)):
                 sys.stderr.write(" %s"%gw[l:r])
@@ -137,20 +219,23 @@ def evaluate(options, trainwords, trainstringpos, goldwords, goldstringpos):
                                  (i,goldwords[i],i,trainwords[i]))
                 break
 
-    pr = str(data_precrec(trainstringpos, goldstringpos))
-    sys.stdout.write(pr)
+    if options.array_flag:
+        (tokenpr, boundarypr) = arrays_precrec(trainstringpos, goldstringpos)
+    else:
+        tokenpr = data_precrec(trainstringpos, goldstringpos)
+        boundarypr = data_precrec(stringpos_boundarypos(trainstringpos), 
+                                  stringpos_boundarypos(goldstringpos))
 
-    pr = str(data_precrec(stringpos_boundarypos(trainstringpos), 
-                          stringpos_boundarypos(goldstringpos)))
-    sys.stdout.write('\t')
-    sys.stdout.write(pr)
+    outf.write(str(tokenpr))
+    outf.write('\t')
+    outf.write(str(boundarypr))
 
     if options.extra:
-        sys.stdout.write('\t')
-        sys.stdout.write(options.extra)
+        outf.write('\t')
+        outf.write(options.extra)
 
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    outf.write('\n')
+    outf.flush()
              
 
 if __name__ == '__main__':
@@ -161,12 +246,16 @@ if __name__ == '__main__':
                       action="store_true", help="gold data is in tree format")
     parser.add_option("--train-trees", dest="traintree_flag", default=False,
                       action="store_true", help="train data is in tree format")
+    parser.add_option("--stream-trees", dest="stream_flag", default=False,
+                      action="store_true", help="extract words from tree input without building the trees")
     parser.add_option("-c", "--score-cat-re", dest="score_cat_re", default=r"^Word$",
                       help="score categories in tree input that match this regex")
     parser.add_option("-i", "--ignore-terminal-re", dest="ignore_terminal_re", default=r"^[$]{3}$",
                       help="ignore terminals that match this regex")
     parser.add_option("-w", "--word-split-re", dest="word_split_re", default=r"[ \t]+",
                       help="regex used to split words with non-tree input")
+    parser.add_option("-a", "--boundary-arrays", dest="array_flag", default=False,
+                      action="store_true", help="score with NumPy boundary arrays (needs numpy)")
     parser.add_option("--extra", dest="extra", help="suffix to print at end of evaluation line")
     parser.add_option("-d", "--debug", dest="debug", help="print debugging information", default=0, type="int")
     (options,args) = parser.parse_args()
@@ -187,6 +276,10 @@ if __name__ == '__main__':
         sys.stderr.write('# score_cat_re = "%s"\n# ignore_terminal_re = "%s"\n# word_split_re = "%s"\n'
                          %(options.score_cat_re, options.ignore_terminal_re, options.word_split_re))
         
+    if options.array_flag and numpy is None:
+        sys.stderr.write("## ** --boundary-arrays requires numpy\n")
+        sys.exit(2)
+
     score_cat_rex = re.compile(options.score_cat_re)
     ignore_terminal_rex = re.compile(options.ignore_terminal_re)
     word_split_rex = re.compile(options.word_split_re)
@@ -195,10 +288,12 @@ if __name__ == '__main__':
                                           tree_flag=options.goldtree_flag, 
                                           score_cat_rex=score_cat_rex,
                                           ignore_terminal_rex=ignore_terminal_rex,
-                                          word_split_rex=word_split_rex)
+                                          word_split_rex=word_split_rex,
+                                          array_flag=options.array_flag,
+                                          stream_flag=options.stream_flag)
 
     # print PrecRecHeader
-    sys.stdout.write("token_f-score\ttoken_precision\ttoken_recall\tboundary_f-score\tboundary_precision\tboundary_recall\n");
+    sys.stdout.write(EvalHeader)
     sys.stdout.flush()
     
     trainlines = []
@@ -212,7 +307,9 @@ if __name__ == '__main__':
                                                 score_cat_rex=score_cat_rex,
                                                 ignore_terminal_rex=ignore_terminal_rex,
                                                 word_split_rex=word_split_rex, 
-                                                debug_level=options.debug)
+                                                debug_level=options.debug,
+                                                array_flag=options.array_flag,
+                                                stream_flag=options.stream_flag)
         evaluate(options, trainwords, trainstringpos, goldwords, goldstringpos)
         trainlines = []
 
@@ -221,7 +318,9 @@ if __name__ == '__main__':
                                                 score_cat_rex=score_cat_rex,
                                                 ignore_terminal_rex=ignore_terminal_rex,
                                                 word_split_rex=word_split_rex, 
-                                                debug_level=options.debug)
+                                                debug_level=options.debug,
+                                                array_flag=options.array_flag,
+                                                stream_flag=options.stream_flag)
         evaluate(options, trainwords, trainstringpos, goldwords, goldstringpos)
 
 
@@ -97,3 +97,39 @@ def writecsvfile(filename, data, header=None):
         outf.writerow(row)
         if header != None and len(header) != len(row):
             print("## Error in zipf:writecsv(): header = %s, row = %s" % (header,row))
+
+
+# Reading py-cfg sample streams
+
+def read_samples(inf, nskip=0, thin=1, maxsamples=None):
+    """read_samples is a generator that yields the samples in inf as
+    lists of lines.  Each sample ends with an empty line; a final
+    sample that is not followed by an empty line is also yielded
+    if it is not empty.
+
+    The first nskip samples (the burn-in) are discarded, and after
+    that only every thin-th sample is yielded, up to at most
+    maxsamples samples.  Discarded samples are only scanned for the
+    empty line that ends them.  inf is always read to the end, so a
+    writer such as py-cfg is never left writing to a closed pipe."""
+
+    def keep(nsample, nyielded):
+        return (nsample >= nskip and (nsample-nskip) % thin == 0
+                and (maxsamples is None or nyielded < maxsamples))
+
+    nsample = 0
+    nyielded = 0
+    keeping = keep(nsample, nyielded)
+    lines = []
+    for line in inf:
+        if len(line) == 0 or line.isspace():
+            if keeping:
+                yield lines
+                nyielded += 1
+                lines = []
+            nsample += 1
+            keeping = keep(nsample, nyielded)
+        elif keeping:
+            lines.append(line.strip())
+    if len(lines) > 0:
+        yield lines
@@ -7,11 +7,31 @@ Minimum Bayes Risk decoder for words/syllables
 
 (c) Mark Johnson
 
-usage: %prog [options]"""
+usage: %prog [options] samplefiles...
+
+The sample files are read one sample at a time, and each sample's parses
+are added to the vote tables of their utterances, so only the vote
+tables are kept in memory and only one file is open at a time.  With --votes
+the vote tables are also written out; with --merge the arguments are
+vote files (e.g., from folds run on different machines), which are
+combined without rereading the samples.
+
+--decode chooses the consensus segmentation:
+  parse     the most frequent segmentation of the utterance (default)
+  boundary  the segmentation maximising expected boundary f-score
+  token     the segmentation maximising expected token f-score
+The last two only keep each utterance's word boundary marginals (and
+need numpy); their vote files hold those marginals, so --merge
+rejects vote files that were not written with the same kind of --decode."""
 
 import lx
 import optparse, re, string, sys
 
+try:
+    import numpy, samplestore
+except ImportError:             # only needed for --decode boundary/token and sample stores
+    numpy = samplestore = None
+
 def readparses(inf):
     parses = []
     for line in inf:
@@ -42,14 +62,263 @@ def most_frequent_parse(*parses):
     parsecounts = lx.count_elements(parses).iteritems()
     return argmax(parsecounts)
 
+def parse_boundaries(parse):
+    """Returns the segments of parse (a string of space-separated words)
+    and its boundary mask, in which bit i is set iff a word ends after
+    segment i"""
+    words = parse.split()
+    mask = 0
+    pos = 0
+    for word in words[:-1]:
+        pos += len(word)
+        mask |= 1 << (pos-1)
+    return ''.join(words), mask
+
+def boundaries_parse(segments, mask):
+    """Inverse of parse_boundaries()"""
+    words = []
+    left = 0
+    for right in xrange(1, len(segments)):
+        if (mask >> (right-1)) & 1:
+            words.append(segments[left:right])
+            left = right
+    words.append(segments[left:])
+    return ' '.join(words)
+
+class VoteTable:
+    """Counts how often each segmentation of one utterance was sampled.
+
+    Every segmentation of an utterance has the same segments, so these
+    are stored once, and each segmentation is interned as its boundary
+    mask (see parse_boundaries()).  Tables for the same utterance can be
+    merged, and written to and read from a line of text."""
+
+    def __init__(self, segments=None):
+        self.segments = segments
+        self.counts = {}
+
+    def add(self, parse, count=1):
+        segments, mask = parse_boundaries(parse)
+        self.add_mask(segments, mask, count)
+
+    def add_mask(self, segments, mask, count=1):
+        if self.segments is None:
+            self.segments = segments
+        elif segments != self.segments:
+            raise ValueError("segments %s don't match utterance %s" % (segments, self.segments))
+        lx.incr(self.counts, mask, count)
+
+    def merge(self, other):
+        for mask, count in other.counts.iteritems():
+            self.add_mask(other.segments, mask, count)
+
+    def most_frequent_parse(self):
+        """Returns the most frequent segmentation; ties go to the one with
+        the smallest mask, so the result doesn't depend on the order in
+        which tables were merged"""
+        mask = argmax(sorted(self.counts.iteritems(), reverse=True))
+        return boundaries_parse(self.segments, mask)
+
+    def __str__(self):
+        return "%s\t%s" % (self.segments, ' '.join("%x:%d" % (mask, count) 
+                                                     for mask, count in self.counts.iteritems()))
+
+def read_votetable(line):
+    "Reads a VoteTable from a line written by str()"
+    segments, votes = line.rstrip('\r\n').split('\t')
+    table = VoteTable(segments)
+    for vote in votes.split():
+        mask, count = vote.split(':')
+        table.add_mask(segments, int(mask, 16), int(count))
+    return table
+
+class BoundaryMarginals:
+    """Accumulates the word boundary marginals of one utterance.
+
+    counts[i] is the number of sampled parses with a word boundary
+    after segment i, out of n parses.  Like VoteTable, these can be
+    merged, and written to and read from a line of text."""
+
+    def __init__(self, segments=None):
+        self.segments = segments
+        self.n = 0
+        self.counts = None
+
+    def add(self, parse, count=1):
+        words = parse.split()
+        segments = ''.join(words)
+        if self.segments is None:
+            self.segments = segments
+        elif segments != self.segments:
+            raise ValueError("segments %s don't match utterance %s" % (segments, self.segments))
+        if self.counts is None:
+            self.counts = numpy.zeros(max(len(segments)-1, 0))
+        ends = numpy.cumsum([len(word) for word in words[:-1]], dtype=int)
+        self.counts[ends-1] += count
+        self.n += count
+
+    def merge(self, other):
+        if self.segments is None:
+            self.segments = other.segments
+        elif other.segments != self.segments:
+            raise ValueError("segments %s don't match utterance %s" % (other.segments, self.segments))
+        if self.counts is None:
+            self.counts = other.counts.copy()
+        else:
+            self.counts += other.counts
+        self.n += other.n
+
+    def marginals(self):
+        return self.counts/max(self.n, 1)
+
+    def boundary_f_parse(self):
+        """Returns the segmentation maximising expected boundary f-score,
+        approximated as 2 sum(p[B]) / (|B| + sum(p)) for boundaries B.
+        For a given |B| this is maximised by the most probable boundaries."""
+        p = self.marginals()
+        order = numpy.argsort(-p, kind='mergesort')
+        fscores = 2*numpy.cumsum(p[order])/(numpy.arange(1, len(p)+1) + p.sum() + 1e-100)
+        nbounds = 0
+        if len(p) > 0 and fscores.max() > 0:
+            nbounds = fscores.argmax()+1
+        mask = 0
+        for i in order[:nbounds]:
+            mask |= 1 << int(i)
+        return boundaries_parse(self.segments, mask)
+
+    def token_f_parse(self):
+        """Returns the segmentation maximising expected token f-score,
+        approximated as 2 E[correct] / (nwords + E[ngoldwords]), treating
+        the boundaries as independent.  For each number of words, a
+        dynamic program over the boundary positions finds the
+        segmentation with the most expected correct words."""
+        n = len(self.segments)
+        if n <= 1:
+            return self.segments
+        b = numpy.ones(n+1)
+        b[1:n] = self.marginals()
+        # correct[i,j] = probability that segments[i:j] is a gold word
+        correct = numpy.empty((n+1, n+1))
+        correct.fill(-numpy.inf)
+        for i in xrange(n):
+            inside = numpy.ones(n-i)
+            inside[1:] = numpy.cumprod(1-b[i+1:n])
+            correct[i,i+1:] = b[i]*b[i+1:]*inside
+        best = numpy.empty(n+1)
+        best.fill(-numpy.inf)
+        best[0] = 0
+        backpointers = []
+        fscores = []
+        for nwords in xrange(1, n+1):
+            scores = best[:,numpy.newaxis] + correct
+            backpointers.append(scores.argmax(0))
+            best = scores.max(0)
+            fscores.append(2*best[n]/(nwords + b[1:n].sum() + 1))
+        nwords = int(numpy.argmax(fscores))+1
+        mask = 0
+        right = n
+        for k in xrange(nwords-1, 0, -1):
+            right = int(backpointers[k][right])
+            mask |= 1 << (right-1)
+        return boundaries_parse(self.segments, mask)
+
+    def __str__(self):
+        return "%s\t%d\t%s" % (self.segments, self.n, ' '.join("%.17g" % count for count in self.counts))
+
+def read_marginals(line):
+    "Reads BoundaryMarginals from a line written by str()"
+    segments, n, counts = line.rstrip('\r\n').split('\t')
+    marginals = BoundaryMarginals(segments)
+    marginals.n = int(n)
+    marginals.counts = numpy.array([float(count) for count in counts.split()])
+    return marginals
+
+def vote_format(line):
+    """Returns "parse" for a line written by VoteTable.__str__(),
+    "marginals" for one written by BoundaryMarginals.__str__(), and None
+    otherwise"""
+    return {2: "parse", 3: "marginals"}.get(line.rstrip('\r\n').count('\t')+1)
+
+def vote_tables(fnames, Table):
+    """Returns a list with a Table for each utterance, to which the
+    utterance's parses in all the samples of all the files in fnames
+    have been added.  Text files are read one sample at a time with
+    lx.read_samples, and files that are sample stores (see
+    samplestore.py) are memory-mapped."""
+    tables = []
+    def add_sample(parses):
+        if not tables:
+            tables.extend(Table() for parse in parses)
+        elif len(parses) != len(tables):
+            sys.stderr.write("## ** samples have different numbers of utterances\n")
+            sys.exit(1)
+        for table, parse in zip(tables, parses):
+            table.add(parse)
+    for fname in fnames:
+        if samplestore and samplestore.is_store(fname):
+            for parses in samplestore.SampleStore(fname).samples():
+                add_sample(list(parses))
+            continue
+        inf = file(fname, "rU")
+        for lines in lx.read_samples(inf):
+            if lines:
+                add_sample([line.strip() for line in lines])
+        inf.close()
+    return tables
+
 if __name__ == "__main__":
     parser = optparse.OptionParser(usage=usage)
     parser.add_option("-s", "--syllables", dest="syllables_flag", action="store_true",
                       help="produce MBR syllables")
+    parser.add_option("-v", "--votes", dest="votesfile",
+                      help="also write the vote tables to this file")
+    parser.add_option("-m", "--merge", dest="merge_flag", action="store_true", default=False,
+                      help="arguments are vote files to merge, not sample files")
+    parser.add_option("-d", "--decode", dest="decode", default="parse",
+                      choices=("parse", "boundary", "token"),
+                      help="consensus to output: parse, boundary or token (default parse)")
     
     (options,args) = parser.parse_args()
-    data = [parses for fname in args for parses in readparses(file(fname, "rU"))]
-    # print "len(data) =", len(data), " sum(len(parses)) =", sum((len(parses) for parses in data))
 
-    for p in map(most_frequent_parse, *data):
-        print(p)
+    if options.decode == "parse":
+        Table, read_table, votes = VoteTable, read_votetable, "parse"
+        decode = VoteTable.most_frequent_parse
+    else:
+        if numpy is None:
+            sys.stderr.write("## ** --decode %s requires numpy\n" % options.decode)
+            sys.exit(2)
+        Table, read_table, votes = BoundaryMarginals, read_marginals, "marginals"
+        if options.decode == "boundary":
+            decode = BoundaryMarginals.boundary_f_parse
+        else:
+            decode = BoundaryMarginals.token_f_parse
+
+    if options.votesfile:
+        votesf = file(options.votesfile, "w")
+    else:
+        votesf = None
+
+    if options.merge_flag:
+        infs = [file(fname, "rU") for fname in args]
+        for fname, inf in zip(args, infs):
+            line = inf.readline()
+            inf.seek(0)
+            if line and vote_format(line) != votes:
+                sys.stderr.write("## ** %s does not hold the %s votes that --decode %s merges\n"
+                                 % (fname, votes, options.decode))
+                sys.exit(1)
+        def tables():
+            for lines in zip(*infs):
+                table = read_table(lines[0])
+                for line in lines[1:]:
+                    table.merge(read_table(line))
+                yield table
+    else:
+        def tables():
+            return vote_tables(args, Table)
+
+    for table in tables():
+        print(decode(table))
+        if votesf:
+            votesf.write(str(table))
+            votesf.write('\n')
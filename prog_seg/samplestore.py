@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+"""samplestore.py stores sampled segmentations compactly.
+
+A .trsws file (the output of trees-words.py) repeats the whole corpus
+in every sample.  A sample store holds the unsegmented corpus once,
+with each segment interned as a one-byte id, and then one record per
+sample holding one bit per possible word boundary of every utterance.
+All records have the same size, so the store can be memory-mapped and
+sample s of utterance u found by arithmetic.
+
+File layout (integers are little-endian uint64 unless noted):
+
+  magic         8 bytes, "TRSWSB1\\n"
+  ninventory    number of distinct segments
+  nutts         number of utterances
+  ncorpus       total number of segments in the corpus
+  recordsize    number of bytes in each sample record
+  inventory     ninventory bytes, segment i is inventory[i]
+  (padding to a multiple of 8 bytes)
+  uttoffsets    nutts+1 offsets of the utterances in corpus
+  bitoffsets    nutts+1 offsets of the utterances' boundary bits in a record
+  corpus        ncorpus bytes, the segment ids of the corpus
+  (padding to a multiple of 8 bytes)
+  records       one record of recordsize bytes per sample
+
+An utterance of n segments has n-1 boundary bits; bit i is set iff
+a word ends after segment i.  Records are at least one byte long.
+"""
+
+usage = """%prog -- convert between .trsws sample files and binary sample stores
+
+usage: %prog [options] infile [outfile]
+
+By default infile is a sample store, which is written out as text in
+.trsws format (so it can be piped into mbr.py or the posterior*.py
+scripts).  With --compile, infile is a .trsws file, which is written
+to the sample store outfile.
+
+"""
+
+import lx
+import optparse, struct, sys
+
+import numpy
+
+magic = "TRSWSB1\n"
+
+def _padding(n):
+    return (-n) % 8
+
+
+class SampleStoreWriter:
+    """Writes samples to a sample store.  The first sample written fixes
+    the corpus; every later sample must segment the same utterances."""
+
+    def __init__(self, outf):
+        self.outf = outf
+        self.segments = None
+
+    def write_sample(self, words):
+        """Appends a sample, given as a list containing a list of words
+        for each utterance"""
+        if self.segments is None:
+            self._write_corpus([''.join(ws) for ws in words])
+        if len(words) != len(self.segments):
+            raise ValueError("sample has %s utterances, corpus has %s" % (len(words), len(self.segments)))
+        positions = []
+        for u, ws in enumerate(words):
+            if ''.join(ws) != self.segments[u]:
+                raise ValueError("segments %s don't match utterance %s" % (''.join(ws), self.segments[u]))
+            pos = self.bitoffsets[u] - 1
+            for w in ws[:-1]:
+                pos += len(w)
+                positions.append(pos)
+        bits = numpy.zeros(8*self.recordsize, dtype=numpy.uint8)
+        bits[positions] = 1
+        self.outf.write(numpy.packbits(bits).tostring())
+
+    def _write_corpus(self, segments):
+        self.segments = segments
+        inventory = sorted(set(''.join(segments)))
+        if len(inventory) > 256:
+            raise ValueError("too many distinct segments (%s) for a sample store" % len(inventory))
+        segid = dict((seg, i) for i, seg in enumerate(inventory))
+        nutts = len(segments)
+        lengths = numpy.array([len(s) for s in segments], dtype=numpy.uint64)
+        uttoffsets = numpy.zeros(nutts+1, dtype='<u8')
+        uttoffsets[1:] = numpy.cumsum(lengths)
+        bitoffsets = numpy.zeros(nutts+1, dtype='<u8')
+        bitoffsets[1:] = numpy.cumsum(numpy.maximum(lengths, 1) - 1)
+        self.bitoffsets = bitoffsets.tolist()
+        self.recordsize = max((self.bitoffsets[-1]+7)//8, 1)
+        corpus = numpy.array([segid[seg] for s in segments for seg in s], dtype=numpy.uint8)
+
+        header = magic + struct.pack("<4Q", len(inventory), nutts, len(corpus), self.recordsize)
+        header += ''.join(inventory)
+        header += '\0'*_padding(len(header))
+        self.outf.write(header)
+        self.outf.write(uttoffsets.tostring())
+        self.outf.write(bitoffsets.tostring())
+        self.outf.write(corpus.tostring())
+        self.outf.write('\0'*_padding(len(corpus)))
+
+    def close(self):
+        self.outf.close()
+
+
+class SampleStore:
+    """Memory-maps a sample store for reading.  Boundary arrays are
+    sliced straight out of the map, and strings are only built when
+    asked for."""
+
+    def __init__(self, fname):
+        self.data = numpy.memmap(fname, dtype=numpy.uint8, mode='r')
+        if self.data[:len(magic)].tostring() != magic:
+            raise ValueError("%s is not a sample store" % fname)
+        pos = len(magic)
+        (ninventory, self.nutts, ncorpus, self.recordsize) = \
+            struct.unpack("<4Q", self.data[pos:pos+32].tostring())
+        pos += 32
+        self.inventory = numpy.array(list(self.data[pos:pos+ninventory].tostring()))
+        pos += ninventory + _padding(ninventory)
+        self.uttoffsets = self.data[pos:pos+8*(self.nutts+1)].view('<u8')
+        pos += 8*(self.nutts+1)
+        self.bitoffsets = self.data[pos:pos+8*(self.nutts+1)].view('<u8')
+        pos += 8*(self.nutts+1)
+        self.corpus = self.data[pos:pos+ncorpus]
+        pos += ncorpus + _padding(ncorpus)
+        self.nsamples = (len(self.data)-pos) // self.recordsize
+        self.records = self.data[pos:pos+self.nsamples*self.recordsize].reshape(self.nsamples, self.recordsize)
+
+    def segments(self, u):
+        "Returns the unsegmented utterance u"
+        return ''.join(self.inventory[self.corpus[self.uttoffsets[u]:self.uttoffsets[u+1]]])
+
+    def boundaries(self, u):
+        """Returns a (nsamples, nsegments-1) array of utterance u's word
+        boundaries in each sample"""
+        left, right = int(self.bitoffsets[u]), int(self.bitoffsets[u+1])
+        bits = numpy.unpackbits(self.records[:, left//8:(right+7)//8], axis=1)
+        return bits[:, left%8:left%8+right-left]
+
+    def utterance_parses(self, u):
+        "Returns the list of utterance u's parses in each sample"
+        segments = self.segments(u)
+        return [boundaries_string(segments, b) for b in self.boundaries(u)]
+
+    def sample_parses(self, s):
+        "Yields the parses of the utterances in sample s"
+        bits = numpy.unpackbits(self.records[s])
+        for u in xrange(self.nutts):
+            yield boundaries_string(self.segments(u), bits[self.bitoffsets[u]:self.bitoffsets[u+1]])
+
+    def samples(self):
+        "Yields a generator of the parses of each sample in turn"
+        for s in xrange(self.nsamples):
+            yield self.sample_parses(s)
+
+
+def boundaries_string(segments, boundaries):
+    """Returns the parse of segments with word boundaries after the
+    segments i for which boundaries[i] is set"""
+    words = []
+    left = 0
+    for right in numpy.flatnonzero(boundaries):
+        words.append(segments[left:right+1])
+        left = right+1
+    words.append(segments[left:])
+    return ' '.join(words)
+
+def is_store(fname):
+    "True if fname is a sample store"
+    inf = file(fname, "rb")
+    start = inf.read(len(magic))
+    inf.close()
+    return start == magic
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-c", "--compile", dest="compile_flag", default=False, action="store_true",
+                      help="write the .trsws infile to the sample store outfile")
+    (options,args) = parser.parse_args()
+    assert(1 <= len(args) <= 2)
+
+    if options.compile_flag:
+        assert(len(args) == 2)
+        writer = SampleStoreWriter(file(args[1], "wb"))
+        for lines in lx.read_samples(file(args[0], "rU")):
+            if lines:
+                writer.write_sample([line.split() for line in lines])
+        writer.close()
+    else:
+        outf = sys.stdout
+        if len(args) >= 2:
+            outf = file(args[1], "w")
+        for parses in SampleStore(args[0]).samples():
+            for parse in parses:
+                outf.write(parse)
+                outf.write('\n')
+            outf.write('\n')
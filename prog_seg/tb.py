@@ -27,6 +27,7 @@ _header_re = re.compile(r"(\*x\*.*\*x\*[ \t]*\n)*\s*")
 _openpar_re = re.compile(r"\s*\(\s*([^ \t\n\r\f\v()]*)\s*")
 _closepar_re = re.compile(r"\s*\)\s*")
 _terminal_re = re.compile(r"\s*((?:[^ \\\t\n\r\f\v()]|\\.)+)\s*")
+_token_re = re.compile(r"\(\s*([^ \t\n\r\f\v()]*)|(\))|((?:[^ \\\t\n\r\f\v()]|\\.)+)")
 
 # This is such a complicated regular expression that I use the special
 # "verbose" form of regular expressions, which lets me index and document it
@@ -69,6 +70,39 @@ def string_trees(s):
     _string_trees(trees, s)
     return trees
 
+def string_words(s, word_rex, ignore_terminal_rex):
+
+    """Returns a list of the words in PTB-format string s, without
+    building its trees.
+
+    A word is the concatenation of the terminals under a node whose
+    label matches word_rex (closing the innermost such node ends the
+    word).  Terminals matching ignore_terminal_rex are skipped, and a
+    leading backslash is removed from the others.  Any terminals left
+    over at the end form a final word.  The result is the same as a
+    preorder visit of string_trees(s), but s is scanned once, left to
+    right, keeping only a stack of which open nodes are word nodes."""
+
+    words, segs, wordnodes = [], [], []
+    for mo in _token_re.finditer(s):
+        label, closepar, terminal = mo.groups()
+        if terminal is not None:
+            if not ignore_terminal_rex.match(terminal):
+                if terminal[0] == '\\':
+                    terminal = terminal[1:]
+                segs.append(terminal)
+        elif closepar is not None:
+            if not wordnodes:       # _string_trees() stops at an unmatched ')'
+                break
+            if wordnodes.pop() and segs:
+                words.append(''.join(segs))
+                segs = []
+        else:
+            wordnodes.append(word_rex.match(label) is not None)
+    if segs:
+        words.append(''.join(segs))
+    return words
+
 def _string_trees(trees, s, pos=0):
     
     """Reads a sequence of trees in string s[pos:].
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+usage = """%prog -- read py-cfg parse trees once and pass the words to several sinks
+
+usage: %prog [options]
+
+py-cfg sends a copy of every sample to each of its -X commands, so running
+eval.py --train-trees and trees-words.py as two -X commands pays for the
+pipe traffic and the tree parsing twice.  This reads the sample stream once,
+extracts the words of each parse once, and feeds them to each sink asked for:
+
+  --trweval  scores every sample against --gold, like eval.py --train-trees
+  --trsws    writes the samples after the burn-in, like trees-words.py
+  --mbr      writes the most frequent segmentation of each utterance after
+             the burn-in, like mbr.py run on this one sample file
+  --votes    writes the vote tables behind --mbr, which mbr.py --merge
+             can combine with those of other runs
+  --store    writes the samples after the burn-in to a binary sample
+             store (see samplestore.py)
+
+"""
+
+import eval, lx, mbr, tb
+import optparse, re, sys
+
+
+class EvalSink:
+    "Scores every sample against the gold data"
+
+    def __init__(self, outf, options, goldwords, goldstringpos):
+        self.outf = outf
+        self.options = options
+        self.goldwords = goldwords
+        self.goldstringpos = goldstringpos
+        outf.write(eval.EvalHeader)
+        outf.flush()
+
+    def sample(self, nsample, words):
+        (trainwords, trainstringpos) = eval.words_data(words, debug_level=self.options.debug,
+                                                       array_flag=self.options.array_flag)
+        eval.evaluate(self.options, trainwords, trainstringpos, 
+                      self.goldwords, self.goldstringpos, self.outf)
+
+    def close(self):
+        pass
+
+
+class WordsSink:
+    "Writes the samples after the first nskip as space-separated words"
+
+    def __init__(self, outf, nskip):
+        self.outf = outf
+        self.nskip = nskip
+
+    def sample(self, nsample, words):
+        if nsample < self.nskip:
+            return
+        for ws in words:
+            self.outf.write(' '.join(ws))
+            self.outf.write('\n')
+        self.outf.write('\n')
+        self.outf.flush()
+
+    def close(self):
+        pass
+
+
+class StoreSink:
+    "Writes the samples after the first nskip to a samplestore.SampleStoreWriter"
+
+    def __init__(self, store, nskip):
+        self.store = store
+        self.nskip = nskip
+
+    def sample(self, nsample, words):
+        if nsample >= self.nskip and words:
+            self.store.write_sample(words)
+
+    def close(self):
+        self.store.close()
+
+
+class MBRSink:
+    """Counts the segmentations of each utterance in the samples after
+    the first nskip in an mbr.VoteTable.  When closed, writes the most
+    frequent segmentations to outf and the vote tables to votesf."""
+
+    def __init__(self, outf, votesf, nskip):
+        self.outf = outf
+        self.votesf = votesf
+        self.nskip = nskip
+        self.tables = []
+
+    def sample(self, nsample, words):
+        if nsample < self.nskip:
+            return
+        if not self.tables:
+            self.tables = [mbr.VoteTable() for ws in words]
+        for (table, ws) in zip(self.tables, words):
+            table.add(' '.join(ws))
+
+    def close(self):
+        for table in self.tables:
+            if self.outf:
+                self.outf.write(table.most_frequent_parse())
+                self.outf.write('\n')
+            if self.votesf:
+                self.votesf.write(str(table))
+                self.votesf.write('\n')
+        for outf in (self.outf, self.votesf):
+            if outf:
+                outf.flush()
+
+
+def fanout(inf, sinks, word_rex, ignore_terminal_rex, debug_level=0):
+    "Extracts the words of each sample in inf once and passes them to each sink"
+    for nsample, lines in enumerate(lx.read_samples(inf)):
+        words = [tb.string_words(line, word_rex, ignore_terminal_rex) 
+                 for line in lines 
+                 if line.count("lexentry") == 0]   # as in trees-words.py
+        if debug_level >= 100:
+            sys.stderr.write("# sample %s, %s utterances\n" % (nsample, len(words)))
+        for sink in sinks:
+            sink.sample(nsample, words)
+    for sink in sinks:
+        sink.close()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-g", "--gold", dest="goldfile", help="gold file (needed for --trweval)")
+    parser.add_option("--trweval", dest="trwevalfile", help="write sample scores to this file")
+    parser.add_option("--trsws", dest="trswsfile", help="write samples after burn-in to this file")
+    parser.add_option("--mbr", dest="mbrfile", help="write most frequent segmentations after burn-in to this file")
+    parser.add_option("--store", dest="storefile", help="write samples after burn-in to this binary sample store")
+    parser.add_option("--votes", dest="votesfile", help="write vote tables after burn-in to this file")
+    parser.add_option("-n", "--nepochs", type="int", dest="nepochs", default=0, help="total number of epochs")
+    parser.add_option("-s", "--skip", type="float", dest="skip", default=0, help="initial fraction of epochs to skip")
+    parser.add_option("-r", "--rate", type="int", dest="rate", default=1, help="input provides samples every rate epochs")
+    parser.add_option("-c", "--score-cat-re", dest="score_cat_re", default=r"^Word$",
+                      help="score categories in tree input that match this regex")
+    parser.add_option("-i", "--ignore-terminal-re", dest="ignore_terminal_re", default=r"^[$]{3}$",
+                      help="ignore terminals that match this regex")
+    parser.add_option("-w", "--word-split-re", dest="word_split_re", default=r"[ \t]+",
+                      help="regex used to split words in the gold file")
+    parser.add_option("-a", "--boundary-arrays", dest="array_flag", default=False,
+                      action="store_true", help="score with NumPy boundary arrays (needs numpy)")
+    parser.add_option("--extra", dest="extra", help="suffix to print at end of evaluation line")
+    parser.add_option("-d", "--debug", dest="debug", help="print debugging information", default=0, type="int")
+    (options,args) = parser.parse_args()
+    assert(len(args) <= 1)
+
+    word_rex = re.compile(options.score_cat_re)
+    ignore_terminal_rex = re.compile(options.ignore_terminal_re)
+    nskip = int(options.skip*options.nepochs/options.rate)
+
+    sinks = []
+    if options.trwevalfile:
+        if not options.goldfile:
+            sys.stderr.write("## ** --trweval needs a --gold file\n")
+            sys.exit(2)
+        if options.array_flag and eval.numpy is None:
+            sys.stderr.write("## ** --boundary-arrays requires numpy\n")
+            sys.exit(2)
+        (goldwords,goldstringpos) = eval.read_data([line.strip() for line in file(options.goldfile, "rU")],
+                                                   tree_flag=False,
+                                                   ignore_terminal_rex=ignore_terminal_rex,
+                                                   word_split_rex=re.compile(options.word_split_re),
+                                                   array_flag=options.array_flag)
+        sinks.append(EvalSink(file(options.trwevalfile, "w"), options, goldwords, goldstringpos))
+    if options.trswsfile:
+        sinks.append(WordsSink(file(options.trswsfile, "w"), nskip))
+    if options.storefile:
+        import samplestore
+        sinks.append(StoreSink(samplestore.SampleStoreWriter(file(options.storefile, "wb")), nskip))
+    if options.mbrfile or options.votesfile:
+        sinks.append(MBRSink(options.mbrfile and file(options.mbrfile, "w"),
+                             options.votesfile and file(options.votesfile, "w"),
+                             nskip))
+    if not sinks:
+        sys.stderr.write("## ** no sinks given, nothing to do\n")
+
+    inf = sys.stdin
+    if len(args) >= 1:
+        inf = file(args[0], "rU")
+    fanout(inf, sinks, word_rex, ignore_terminal_rex, options.debug)
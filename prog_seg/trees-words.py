@@ -41,33 +41,44 @@ def tree_string(tree):
         wordssofar.append(''.join(segssofar))
     return ' '.join(wordssofar)
     
-def read_write(inf, outf=sys.stdout, nskip=0):
-    "Reads data from inf in tree format"
-    for line in inf:
-        line = line.strip()
-	#hacky way of exlucding the spurious entries
-        if line.count("lexentry")>0:
-            continue
+def read_write(inf, outf=sys.stdout, nskip=0, stream_flag=False, thin=1, maxsamples=None, store=None):
+    """Reads data from inf in tree format.  Only the samples kept by
+    lx.read_samples() are parsed; the skipped ones are just scanned
+    for the empty line that ends them.  If store is a
+    samplestore.SampleStoreWriter the samples are written to it
+    instead of to outf."""
 
-        if len(line) > 0:
-            if nskip <= 0:
-                trees = tb.string_trees(line)
-                trees.insert(0, 'ROOT')
-                outf.write(tree_string(trees).strip())
-                outf.write('\n')
+    def line_words(line):
+        if stream_flag:
+            return tb.string_words(line, word_rex, ignore_terminal_rex)
         else:
-            if nskip <= 0:
-                outf.write('\n')
-                outf.flush()
-            nskip -= 1
-        trees = tb.string_trees(line)
-        trees.insert(0, 'ROOT')
+            trees = tb.string_trees(line)
+            trees.insert(0, 'ROOT')
+            return tree_string(trees).split()
+
+    for lines in lx.read_samples(inf, nskip, thin, maxsamples):
+	#hacky way of exlucding the spurious entries
+        words = [line_words(line) for line in lines if line.count("lexentry") == 0]
+        if store:
+            if words:
+                store.write_sample(words)
+            continue
+        for ws in words:
+            outf.write(' '.join(ws))
+            outf.write('\n')
+        outf.write('\n')
+        outf.flush()
 
 if __name__ == '__main__':
     parser = optparse.OptionParser(usage=usage)
     parser.add_option("-n", "--nepochs", type="int", dest="nepochs", default=0, help="total number of epochs")
     parser.add_option("-s", "--skip", type="float", dest="skip", default=0, help="initial fraction of epochs to skip")
     parser.add_option("-r", "--rate", type="int", dest="rate", default=1, help="input provides samples every rate epochs")
+    parser.add_option("-t", "--thin", type="int", dest="thin", default=1, help="after the skipped epochs, keep every thin-th sample")
+    parser.add_option("-m", "--max-samples", type="int", dest="maxsamples", default=None, help="keep at most this many samples")
+    parser.add_option("--stream-trees", dest="stream_flag", default=False,
+                      action="store_true", help="extract words without building the trees")
+    parser.add_option("--store", dest="storefile", help="write the samples to this binary sample store (see samplestore.py)")
     parser.add_option("-c", "--score-cat-re", dest="score_cat_re", default=r"Word\b",
                       help="score categories in tree input that match this regex")
     parser.add_option("-i", "--ignore-terminal-re", dest="ignore_terminal_re", default=r"^[$]{3}$",
@@ -83,4 +94,10 @@ if __name__ == '__main__':
         if len(args) >= 2:
             outf = file(args[1], "w")
     nskip = int(options.skip*options.nepochs/options.rate)
-    read_write(inf, outf, nskip)
+    store = None
+    if options.storefile:
+        import samplestore
+        store = samplestore.SampleStoreWriter(file(options.storefile, "wb"))
+    read_write(inf, outf, nskip, options.stream_flag, options.thin, options.maxsamples, store)
+    if store:
+        store.close()
@@ -21,6 +21,14 @@
 
 import sys,math
 
+NEGINF = float("-inf")
+
+def logsumexp(xs):
+    m = max(xs)
+    if m==NEGINF:
+        return m
+    return m+math.log(sum(math.exp(x-m) for x in xs))
+
 class Unigram:
     def __init__(self,gf):
         self.wprobs = {} #maps word to probability
@@ -30,6 +38,14 @@ class Unigram:
             l = l.split()
             p = float(l[0])
             self.wprobs[l[1]]=p
+        # character trie over the lexicon, a node maps characters to nodes
+        # and the key None of a word's last node to the word's probability
+        self.trie = {}
+        for (w,p) in self.wprobs.iteritems():
+            node = self.trie
+            for c in w:
+                node = node.setdefault(c,{})
+            node[None] = p
     
 
     def prob(self,w):
@@ -38,27 +54,90 @@ class Unigram:
         except KeyError:
             return 0.0
 
+    def spans(self,text):
+        """returns a list whose j-th entry lists the (i,p) for which the segments
+        text[i:j] spell a word of probability p>0, in increasing order of i
+
+        the spans are found by walking the trie from each start position, so
+        only spans that are prefixes of lexicon entries are visited
+        """
+        ending = [[] for j in range(len(text)+1)]
+        for i in range(len(text)):
+            node = self.trie
+            for j in range(i,len(text)):
+                for c in text[j]:
+                    node = node.get(c)
+                    if node is None:
+                        break
+                if node is None:
+                    break
+                p = node.get(None,0.0)
+                if p>0:
+                    ending[j+1].append((i,p))
+        return ending
+
     def parse(self,text):
         #we use length-addressing
         #chart[0] stores all analyses ranging from 0 to 1
         chart = [[] for i in range(len(text))]
-#        chart[0] = [(w,p) for w in self.wprobs.keys() if w==text[0]]
+        ending = self.spans(text)
         for slen in range(len(text)):
-            w = "".join(text[:slen+1])
-            p = self.prob(w)
-#            print w,p
-            if p>0:
-#                p = math.log(p)
-                chart[slen].append((-1,p))
-            for spos in range(1,slen+1):
-                w = "".join(text[spos:slen+1])
-                p = self.prob(w)
-                if p>0:
-#                    p = math.log(p)
+            for (spos,p) in ending[slen+1]:
+                if spos==0:
+                    chart[slen].append((-1,p))
+                else:
                     for (oldseg,oldp) in chart[spos-1]:
                         chart[slen].append((spos-1,oldp*p))
         return chart
 
+    def analyse(self,text):
+        """forward pass over all the segmentations of text (a list of segments)
+        in log space, visiting only the spans that spell lexicon entries
+
+        returns (logZ,ent,nparses,bestseg,logbest): the log partition function,
+        the entropy (in bits) of the distribution over segmentations, the number
+        of segmentations with non-zero probability, the Viterbi segmentation as
+        a list of words and its unnormalized log probability
+
+        ties between equally probable segmentations are broken as in parse(),
+        in favour of the one whose last word starts earliest
+        """
+        n = len(text)
+        logalpha = [NEGINF]*(n+1) #logalpha[j] is the log-probability of text[:j]
+        logalpha[0] = 0.0
+        explog = [0.0]*(n+1)      #expected log-probability of a segmentation of text[:j]
+        counts = [0]*(n+1)        #number of segmentations of text[:j]
+        counts[0] = 1
+        viterbi = [NEGINF]*(n+1)
+        viterbi[0] = 0.0
+        back = [-1]*(n+1)
+        ending = self.spans(text)
+        for j in range(1,n+1):
+            terms = []
+            for (i,p) in ending[j]:
+                if counts[i]==0:
+                    continue
+                lp = math.log(p)
+                terms.append((logalpha[i]+lp,explog[i]+lp))
+                counts[j] += counts[i]
+                if viterbi[i]+lp>viterbi[j]:
+                    viterbi[j] = viterbi[i]+lp
+                    back[j] = i
+            if terms:
+                logalpha[j] = logsumexp([a for (a,e) in terms])
+                explog[j] = sum(math.exp(a-logalpha[j])*e for (a,e) in terms)
+        bestseg = []
+        j = n
+        while j>0 and counts[n]>0:
+            bestseg.append("".join(text[back[j]:j]))
+            j = back[j]
+        bestseg.reverse()
+        if counts[n]>1:
+            ent = max(logalpha[n]-explog[n],0.0)/math.log(2)
+        else:
+            ent = 0.0
+        return (logalpha[n],ent,counts[n],bestseg,viterbi[n])
+
 def log2(x):
     return math.log(x)/math.log(2)
 
@@ -78,26 +157,17 @@ if __name__=="__main__":
     g = Unigram(sys.argv[1])
     print "entropyseg entropyall entropyred nparses \"bestparse\" p(bestparse)"
     for l in sys.stdin:
-        chart = g.parse(l.strip().split())
-        parses = chart[-1]
-        ent = 0.0
+        (logZ,ent,nparses,bestseg,logbest) = g.analyse(l.strip().split())
         entropyall = log2(2**(len(l.split())-1))
-        bestparse=-1
-        bestp=0
-        normalize = sum([x[1] for x in parses]) #[math.exp(x[1]) for x in parses]) 
-        for (i,parse) in enumerate(parses):
-#            p = math.exp(parse[1])/normalize
-            p = parse[1]/normalize
-            ent = ent - p*log2(p)
-            if p>bestp:
-                bestparse=parse
-                bestp=p
-        bestseg = findbestparse(l.strip().split(),chart,bestparse)
-        bestseg.reverse()
+        if nparses==0:
+            sys.stderr.write("no segmentation of: %s\n"%l.strip())
+            print "NaN %s NaN 0 \"\" 0"%entropyall
+            continue
+        bestp = math.exp(logbest-logZ)
         bestseg = " ".join(bestseg)
         try:
             entropyred = 1-ent/entropyall
         except ZeroDivisionError:
             entropyred = "NaN"
-        print "%s %s %s %s \"%s\" %s"%(ent,entropyall,entropyred,len(parses),bestseg,bestp)
+        print "%s %s %s %s \"%s\" %s"%(ent,entropyall,entropyred,nparses,bestseg,bestp)
 
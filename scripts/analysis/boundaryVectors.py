@@ -0,0 +1,143 @@
+"""
+  single-pass extraction of word and syllable boundaries from segmented
+  strings, shared by evaluate.py, segUtils.py and the scripts built on them
+
+  a segmented string such as "the kit.ty" is scanned once into the number
+  of segments n and the list of boundary events (i,symbol), one for each
+  boundary symbol that occurs right before segment i; words, boundary
+  sets, syllables and boundary vectors are all read off these events
+
+  every boundary symbol must stand between two segments; the original
+  per-function loops each misread strings with leading, trailing or
+  repeated boundary symbols in their own way, so such strings are
+  rejected with a ValueError instead
+"""
+
+import doctest
+
+WBSYMBOL=" "
+SBSYMBOL="."
+
+def scan(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns (n,events) for the segmented string s
+
+    >>> scan("the kit.ty")
+    (8, [(3, ' '), (6, '.')])
+    >>> scan("a. ")
+    Traceback (most recent call last):
+    ...
+    ValueError: boundary symbol ' ' at position 2 of 'a. ' is not between two segments
+    >>> scan(" the kitty")
+    Traceback (most recent call last):
+    ...
+    ValueError: boundary symbol ' ' at position 0 of ' the kitty' is not between two segments
+    >>> scan("the  kit..ty")
+    Traceback (most recent call last):
+    ...
+    ValueError: boundary symbol ' ' at position 4 of 'the  kit..ty' is not between two segments
+    >>> scan("the kit. ty")
+    Traceback (most recent call last):
+    ...
+    ValueError: boundary symbol ' ' at position 8 of 'the kit. ty' is not between two segments
+    """
+    events = []
+    i = 0
+    for (pos,c) in enumerate(s):
+        if c==wbsymbol or c==sbsymbol:
+            if i==0 or (events and events[-1][0]==i) or pos==len(s)-1:
+                raise ValueError("boundary symbol %r at position %d of %r is not between two segments"%(c,pos,s))
+            events.append((i,c))
+        else:
+            i+=1
+    return (i,events)
+
+def spans(n,positions):
+    """returns the set of (start,end) spans between the boundary positions,
+    ending in max(n,1) like the original loops
+
+    >>> sorted(spans(8,[3,6]))
+    [(0, 3), (3, 6), (6, 8)]
+    """
+    res = set()
+    start = 0
+    for i in positions:
+        res.add((start,i))
+        start = i
+    res.add((start,max(n,1)))
+    return res
+
+def words(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns a set of word spans
+
+    >>> sorted(words("the kit.ty"))
+    [(0, 3), (3, 8)]
+    """
+    (n,events) = scan(s,wbsymbol,sbsymbol)
+    return spans(n,[i for (i,c) in events if c==wbsymbol])
+
+def wbs(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns a set of word-boundary indices, syllable boundaries are ignored"""
+    return set(i for (i,c) in scan(s,wbsymbol,sbsymbol)[1] if c==wbsymbol)
+
+def sbs(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns a set of syllable-boundary indices, including word boundaries"""
+    return set(i for (i,c) in scan(s,wbsymbol,sbsymbol)[1])
+
+def syllables(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns a set of syllable spans"""
+    (n,events) = scan(s,wbsymbol,sbsymbol)
+    return spans(n,[i for (i,c) in events])
+
+def bvec(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL,ignoreSyll=True):
+    """returns a list with one entry for each position between two segments,
+    "b" for a word boundary, "s" for a syllable boundary and "n" otherwise
+
+    >>> bvec("the kit.ty")
+    ['n', 'n', 'b', 'n', 'n', 'n', 'n']
+    >>> bvec("the kit.ty",ignoreSyll=False)
+    ['n', 'n', 'b', 'n', 'n', 's', 'n']
+    """
+    (n,events) = scan(s,wbsymbol,sbsymbol)
+    res = ["n"]*max(n-1,0)
+    for (i,c) in events:
+        if c==wbsymbol:
+            res[i-1] = "b"
+        elif not ignoreSyll and res[i-1]=="n":
+            res[i-1] = "s"
+    return res
+
+def analyse(s,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns (words,wbs,sbs,syllables) for s from a single scan
+
+    >>> [sorted(x) for x in analyse("the kit.ty")]
+    [[(0, 3), (3, 8)], [3], [3, 6], [(0, 3), (3, 6), (6, 8)]]
+    """
+    (n,events) = scan(s,wbsymbol,sbsymbol)
+    wpos = [i for (i,c) in events if c==wbsymbol]
+    spos = [i for (i,c) in events]
+    return (spans(n,wpos),set(wpos),set(spos),spans(n,spos))
+
+"""
+  batch versions over a whole corpus; each returns a list with one entry
+  per string
+"""
+
+def analyseAll(strings,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    """returns the lists (words,wbs,sbs,syllables) for all the strings"""
+    res = ([],[],[],[])
+    for s in strings:
+        for (l,x) in zip(res,analyse(s,wbsymbol,sbsymbol)):
+            l.append(x)
+    return res
+
+def wordsAll(strings,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    return [words(s,wbsymbol,sbsymbol) for s in strings]
+
+def wbsAll(strings,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL):
+    return [wbs(s,wbsymbol,sbsymbol) for s in strings]
+
+def bvecAll(strings,wbsymbol=WBSYMBOL,sbsymbol=SBSYMBOL,ignoreSyll=True):
+    return [bvec(s,wbsymbol,sbsymbol,ignoreSyll) for s in strings]
+
+if __name__=="__main__":
+    doctest.testmod()
@@ -9,7 +9,7 @@
   segmentations have same format as gold standards
 """
 
-import sys
+import sys, boundaryVectors
 
 WBSYMBOL=" "
 SBSYMBOL="."
@@ -18,75 +18,27 @@ SBSYMBOL="."
   returns a set of word pairs
 """
 def words(s):
-    res = set()
-    i=1
-    sPos=1
-    start=0
-    s = s.replace(SBSYMBOL,"")
-    while i<len(s.replace(WBSYMBOL,"")):
-        if s[sPos]==" ":
-            res.add((start,i))
-            sPos+=1
-            start=i
-        else: 
-            sPos+=1
-            i+=1
-    res.add((start,i))
-    return res
+    return boundaryVectors.words(s,WBSYMBOL,SBSYMBOL)
 
 """
   returns a set of word-boundary indices
 """
 def wbs(s):
-    res = set()
-    i=1       
-    sPos=1
-    s = s.replace(SBSYMBOL,"") #syllables ignored in word-boundary eval
-    while i<len(s.replace(WBSYMBOL,"")):
-        if s[sPos]==WBSYMBOL:
-            res.add(i)
-            sPos+=1
-        else: 
-            sPos+=1
-            i+=1
-    return res
+    return boundaryVectors.wbs(s,WBSYMBOL,SBSYMBOL) #syllables ignored in word-boundary eval
 
 
 """
   returns a set of syllable-boundary indices
 """
 def sbs(s):
-    res = set()
-    i=1       
-    sPos=1    
-    while i<len(s.replace(WBSYMBOL,"").replace(SBSYMBOL,"")):
-        if s[sPos]==SBSYMBOL or s[sPos]==WBSYMBOL:
-            res.add(i)
-            sPos+=1
-        else: 
-            sPos+=1
-            i+=1
-    return res
+    return boundaryVectors.sbs(s,WBSYMBOL,SBSYMBOL)
 
 """
   returns a set of syllables
 """
 
 def syllables(s):
-    res = set()
-    i=1
-    sPos=1
-    start=0
-    while i<len(s.replace(WBSYMBOL,"").replace(SBSYMBOL,"")):
-        if s[sPos]==SBSYMBOL or s[sPos]==WBSYMBOL:
-            res.add((start,i))
-            sPos+=1
-            start=i
-        else: 
-            sPos+=1
-            i+=1
-    res.add((start,i))
-    return res
+    return boundaryVectors.syllables(s,WBSYMBOL,SBSYMBOL)
 
 
 """
@@ -136,14 +88,8 @@ def evaluate(goldstrings,predstrings):
         goldstypes.update(g.replace("."," ").split(" "))
         predstypes.update(p.replace("."," ").split(" "))
 
-    goldwbs = [wbs(x) for x in goldstrings]
-    predwbs = [wbs(x) for x in predstrings]
-    goldwords = [words(x) for x in goldstrings]
-    predwords = [words(x) for x in predstrings]
-    goldsbs = [sbs(x) for x in goldstrings]
-    predsbs = [sbs(x) for x in predstrings]
-    goldsylls = [syllables(x) for x in goldstrings]
-    predsylls = [syllables(x) for x in predstrings]
+    (goldwords,goldwbs,goldsbs,goldsylls) = boundaryVectors.analyseAll(goldstrings,WBSYMBOL,SBSYMBOL)
+    (predwords,predwbs,predsbs,predsylls) = boundaryVectors.analyseAll(predstrings,WBSYMBOL,SBSYMBOL)
     evaluateSets(goldwbs,predwbs)
     evaluateSets(goldwords,predwords)
     evaluateSets(goldsbs,predsbs)
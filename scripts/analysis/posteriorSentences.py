@@ -14,7 +14,7 @@
 
 """
 
-import sys, evaluate
+import sys, evaluate, boundaryVectors
 from math import log,sqrt
 
 l2norm = log(2)
@@ -76,6 +76,7 @@ if __name__=="__main__":
     allEntropies = []
     for i in counts.keys():
         goldwb = evaluate.words(goldsents[i])
+        segwords = dict((seg,evaluate.words(seg)) for seg in counts[i])
         norm = float(sum(counts[i].values()))
         ent = entropy([x / norm for x in counts[i].values()])
         allEntropies.append(ent)
@@ -84,25 +85,20 @@ if __name__=="__main__":
         for threshold in thresholds:
             if ent < threshold/10.0:
                 entropyBest[threshold].append((highestseg,i))
-        highestwb = evaluate.words(highestseg)
+        highestwb = segwords[highestseg]
         expectedF = 0
         tmpFscores = []
         for (seg,count) in sorted(counts[i].iteritems(),lambda x,y:-cmp(x[1],y[1])):
-            predwb = evaluate.words(seg.replace(".",""))
-            tmpFscores.append(evaluate.evaluate_ind(goldwb,predwb)[2])
+            tmpFscores.append(evaluate.evaluate_ind(goldwb,segwords[seg])[2])
             expectedF += count/norm*tmpFscores[-1]
         sys.stdout.write("sent %d, %.3f, %.3f, %.2f (%.2f), %s\n"%(i,ent,ent/len(goldsents[i].replace(" ","")),evaluate.evaluate_ind(goldwb,highestwb)[2],expectedF,goldsents[i]))
-        for (seg,count) in sorted(counts[i].iteritems(),lambda x,y:-cmp(x[1],y[1])):
-            predwb = evaluate.words(seg)
-            tf = evaluate.evaluate_ind(goldwb,predwb)[2]
+        for ((seg,count),tf) in zip(sorted(counts[i].iteritems(),lambda x,y:-cmp(x[1],y[1])),tmpFscores):
             if seg == goldsents[i]:
                 sys.stdout.write("->%.2f %d %.2f\t%s\n"%(count/norm,count,tf,seg))
             else:
                 sys.stdout.write("  %.2f %d %.2f\t%s\n"%(count/norm,count,tf,seg))
-    allGoldWords = [evaluate.words(goldsents[x[1]]) for x in allBest]
-    allGoldBounds = [evaluate.wbs(goldsents[x[1]]) for x in allBest]
-    allBestWords = [evaluate.words(x[0]) for x in allBest]
-    allBestBounds = [evaluate.wbs(x[0]) for x in allBest]
+    (allGoldWords,allGoldBounds) = boundaryVectors.analyseAll([goldsents[x[1]] for x in allBest])[:2]
+    (allBestWords,allBestBounds) = boundaryVectors.analyseAll([x[0] for x in allBest])[:2]
     allGoldTypes = evaluate.types([goldsents[x[1]] for x in allBest])
     allBestTypes = evaluate.types([x[0] for x in allBest])
     sys.stdout.write("\n")
@@ -112,8 +108,8 @@ if __name__=="__main__":
     sys.stdout.write("all boundary-p: %.2f\nall boundary-r: %.2f\n"%(scores[0],scores[1]))
     sys.stdout.write("all lexic-p: %.2f (of %d)\n"%(evaluate.evaluate_ind(allGoldTypes,allBestTypes)[0],len(allBestTypes)))
     for threshold in thresholds:
-        entropyGoldWords = [evaluate.words(goldsents[x[1]]) for x in entropyBest[threshold]]
-        entropyWords = [evaluate.words(x[0]) for x in entropyBest[threshold]]
+        entropyGoldWords = boundaryVectors.wordsAll([goldsents[x[1]] for x in entropyBest[threshold]])
+        entropyWords = boundaryVectors.wordsAll([x[0] for x in entropyBest[threshold]])
         entropyGoldTypes = evaluate.types([goldsents[x[1]] for x in entropyBest[threshold]])
         entropyTypes = evaluate.types([x[0] for x in entropyBest[threshold]])
         sys.stdout.write("%.2f token-f: %.2f (of %d, avg length=%.2f)\n"%(threshold/10.0,evaluate.evaluateSets(entropyGoldWords,entropyWords)[2],len(entropyBest[threshold]),sum(len(goldsents[x[1]].replace(" ","")) for x in entropyBest[threshold])/float(len(entropyBest[threshold]))))
@@ -1,4 +1,4 @@
-import doctest,sys
+import boundaryVectors,doctest,sys
 
 SBSYMBOL=""
 WBSYMBOL=" "
@@ -11,22 +11,18 @@ def getBVec(t,ignoreSyll=True):
 
     >>> getBVec("the kit.ty",False)
     ["n","n","b","n","n","s","n"]
+
+    >>> getBVec("a. ")
+    Traceback (most recent call last):
+    ...
+    ValueError: boundary symbol ' ' at position 2 of 'a. ' is not between two segments
+
+    >>> getBVec("the  kitty")
+    Traceback (most recent call last):
+    ...
+    ValueError: boundary symbol ' ' at position 4 of 'the  kitty' is not between two segments
     """
-    res = []
-    pos = 1
-    if ignoreSyll:
-        t = t.replace(SBSYMBOL,"")
-    while pos<len(t):
-        if t[pos]==SBSYMBOL:
-            res.append("s")
-            pos+=2
-        elif t[pos]==WBSYMBOL:
-            res.append("b")
-            pos+=2
-        else:
-            res.append("n")
-            pos+=1
-    return res
+    return boundaryVectors.bvec(t,WBSYMBOL,SBSYMBOL,ignoreSyll)
 
 def segment(text,vec):
     """given a vectorial segmentation of text, generate the segmented string
@@ -68,18 +64,4 @@ def segment(text,vec):
   returns a set of word pairs
 """
 def words(s):
-    res = set()
-    i=1
-    sPos=1
-    start=0
-    s = s.replace(SBSYMBOL,"")
-    while i<len(s.replace(WBSYMBOL,"")):
-        if s[sPos]==WBSYMBOL:
-            res.add((start,i))
-            sPos+=1
-            start=i
-        else: 
-            sPos+=1
-            i+=1
-    res.add((start,i))
-    return res
+    return boundaryVectors.words(s,WBSYMBOL,SBSYMBOL)
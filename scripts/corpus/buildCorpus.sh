@@ -1,4 +1,3 @@
-#assuming that pakna_test has already been built
 #this generates a random corpus for a random language
 #does not rebuild the lexicon if already has been built
 
@@ -6,20 +5,15 @@ lang=$1
 struct=$2
 freqdist=$3
 version=$4
-
-if ! [ -e pakna_test.txt ]
-then
-  echo Generating pakna_test
-  echo python make_pakna.py
-  python make_pakna.py
-fi
+# worker processes used for scoring
+jobs=${JOBS:-$(nproc)}
 
 # checking for existence of lexicon
 if ! [ -e scored_${lang}_${struct}.gz ]
 then
   echo Generating the base distribution by executing the following:
-  echo python phomentCompress.py pakna_feats.txt -w ./ -g grammar_${lang}_${struct}.txt -T pakna_test.txt | gzip > scored_${lang}_${struct}.txt
-python phomentCompress.py pakna_feats.txt -w ./ -g grammar_${lang}_${struct}.txt -T pakna_test.txt | gzip > scored_${lang}_${struct}.gz
+  echo "python phomentCompress.py pakna_feats.txt -w ./ -g grammar_${lang}_${struct}.txt --enumerateTest 6 --minHarmony -25.0 -z 6 -j ${jobs} > scored_${lang}_${struct}.gz"
+python phomentCompress.py pakna_feats.txt -w ./ -g grammar_${lang}_${struct}.txt --enumerateTest 6 --minHarmony -25.0 -z 6 -j ${jobs} > scored_${lang}_${struct}.gz
 fi
 
 echo Generating a pseudo-${lang} corpus by executing the following:
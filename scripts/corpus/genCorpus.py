@@ -2,88 +2,139 @@
   Corpus-Generator for Fourtassi, Daland, Boerschinger project
   
 
-  python genCorpus.py [-a[=0.0]] [-b[=200]] [-m[=2]] [-M[=3]] <N> <base>
+  python genCorpus.py [-a[=0.0]] [-b[=200]] [-m[=2]] [-M[=3]] [-d <dict>] [-s <seed>] <N> <base>
   
-  <base> is either "geo" or "cv",
+  <base> is either "geo", "cv" or "dict",
   <N> is the number of utterances
 
   -a  the discount parameter
   -b  the concentration parameter
   -m  mean length of a word, in "segments"
   -M  mean length of utterance, in words
+  -d  dictionary of words for the "dict" base, one per line, segments
+      separated by ":"; it is compiled into <dict>.idx (see compileDict)
+      the first time it is used, or whenever it is newer than the index,
+      or under the cache directory if the dictionary's directory is not
+      writable (see defaultIndex)
+  -i  compiled index of the dictionary, instead of the default location
+  -s  random seed; the restaurant draws from Python's random module and
+      the geo and cv bases draw words in batches from numpy.random, so both
+      are seeded with it
 """
 
-import random, sys, argparse
+import random, sys, argparse, os, struct, math, hashlib, tempfile
+from array import array
+import numpy
+
+def nSegs(obs):
+    """
+      number of segments of obs, a word as sampled (segments joined by ":")
+      or a sequence of segments
+    """
+    if isinstance(obs,basestring):
+        return obs.count(":")+1
+    return len(obs)
+
+def joinWords(segs,lengths):
+    """
+      splits the list segs into consecutive words of the given lengths
+    """
+    ends = numpy.cumsum(lengths).tolist()
+    return [":".join(segs[start:end]) for (start,end) in zip([0]+ends[:-1],ends)]
 
 class BaseGeo(object):
     """
       GEO-distribution assumes a geometric distribution over word-lengths,
       uniform distribution over phonemes
     """
-    def __init__(self,segs="P T K F S X M N NG L R W J A E I O U".split(),pStop=0.5):
+    def __init__(self,segs="P T K F S X M N NG L R W J A E I O U".split(),pStop=0.5,batchSize=1000):
         """
         @segs:   list of segments that can make up words
         @pStop:  parameter of the geometric word-length distribution
+        @batchSize: number of words sample() draws at a time
         """
         self.segs = segs
         self.pStop = pStop
         self.pPhon = 1/float(len(self.segs))
+        self.batchSize = batchSize
+        self.buffer = []
 
     def predProb(self,obs):
-        return ((1-self.pStop)*self.pPhon)**len(obs) * self.pStop/(1-self.pStop)
+        return ((1-self.pStop)*self.pPhon)**nSegs(obs) * self.pStop/(1-self.pStop)
+
+    def predProbs(self,obs):
+        """
+          predProb of each observation in the list obs, as an array
+        """
+        lengths = numpy.array([nSegs(o) for o in obs])
+        return ((1-self.pStop)*self.pPhon)**lengths * self.pStop/(1-self.pStop)
 
     def sample(self):
-        res = []
-        res.append(self.sampleSegment())
-        stop = random.random()
-        while stop>self.pStop:
-            stop = random.random()
-            res.append(self.sampleSegment())
-        return ":".join(res)
+        if not self.buffer:
+            self.buffer = self.sampleBatch(self.batchSize)
+        return self.buffer.pop()
+
+    def sampleBatch(self,n):
+        """
+          n words at once: their lengths are geometric, and the segments of all
+          of them are drawn as one array of uniform indices into segs
+        """
+        lengths = numpy.random.geometric(self.pStop,n)
+        indices = numpy.random.randint(0,len(self.segs),lengths.sum())
+        return joinWords(numpy.array(self.segs,dtype=object)[indices].tolist(),lengths)
 
     def sampleSegment(self):
-        cur = 0
-        i = -1
-        flip = random.random()
-        while cur<=flip:
-            cur+=self.pPhon
-            i+=1
-        return self.segs[i]
+        return self.segs[int(random.random()*len(self.segs))]
 
 class BaseGeoCV(object):
     """
       CV-GEO-distribution assumes a geometric distribution over word-lengths,
       uniform distribution over phonemes, but only admits "(CV)+"-words
     """
-    def __init__(self,segsC="P T K F S X M N NG L R W J".split(),segsV="A E I O U".split(),pStop=0.5):
+    def __init__(self,segsC="P T K F S X M N NG L R W J".split(),segsV="A E I O U".split(),pStop=0.5,batchSize=1000):
         """
         @segsC:  list of consonants
         @segsV:  list of vowels
         @pStop:  parameter of the geometric word-length distribution
+        @batchSize: number of words sample() draws at a time
         """
         self.segsC = segsC
         self.segsV = segsV
         self.pStop = pStop
         self.pPhonC = 1/float(len(self.segsC))
         self.pPhonV = 1/float(len(self.segsV))
+        self.batchSize = batchSize
+        self.buffer = []
 
     def predProb(self,obs):
         res = 1
-        for i in range(len(obs),step=2):
-            pair = obs[i:i+2]
+        for i in range(0,nSegs(obs),2):
             res = res*(1-self.pStop)*self.pPhonC*self.pPhonV
         return res * self.pStop/(1-self.pStop)
 
+    def predProbs(self,obs):
+        """
+          predProb of each observation in the list obs, as an array
+        """
+        pairs = (numpy.array([nSegs(o) for o in obs])+1)//2
+        return ((1-self.pStop)*self.pPhonC*self.pPhonV)**pairs * self.pStop/(1-self.pStop)
+
     def sample(self):
-        res = []
-        res.append(self.sampleSegmentC())
-        res.append(self.sampleSegmentV())
-        stop = random.random()
-        while stop>self.pStop:
-            stop = random.random()
-            res.append(self.sampleSegmentC())
-            res.append(self.sampleSegmentV())
-        return ":".join(res)
+        if not self.buffer:
+            self.buffer = self.sampleBatch(self.batchSize)
+        return self.buffer.pop()
+
+    def sampleBatch(self,n):
+        """
+          n words at once: their numbers of CV pairs are geometric, and their
+          consonants and vowels are drawn as two arrays of uniform indices
+        """
+        pairs = numpy.random.geometric(self.pStop,n)
+        total = pairs.sum()
+        segs = numpy.empty(2*total,dtype=object)
+        segs[0::2] = numpy.array(self.segsC,dtype=object)[numpy.random.randint(0,len(self.segsC),total)]
+        segs[1::2] = numpy.array(self.segsV,dtype=object)[numpy.random.randint(0,len(self.segsV),total)]
+        return joinWords(segs.tolist(),2*pairs)
 
     def sampleSegmentC(self):
         return self.sampleSegment(self.segsC,self.pPhonC)
@@ -92,82 +143,249 @@ class BaseGeoCV(object):
         return self.sampleSegment(self.segsV,self.pPhonV)
 
     def sampleSegment(self,segs,p):
-        cur = 0
-        i = -1
-        flip = random.random()
-        while cur<=flip:
-            cur+=p
-            i+=1
-        return segs[i]
+        return segs[int(random.random()*len(segs))]
+
+dictMagic = "GCDICT1\n"
+
+def compileDict(f,idxFile):
+    """
+      writes the index of dictionary f to idxFile:
+
+        magic       8 bytes, "GCDICT1\\n"
+        maxLength   the largest number of segments of an entry
+        nEntries    number of entries
+        nBytes      total length of the entries
+        buckets     maxLength+2 entry offsets, the entries of length L are
+                    entries buckets[L] to buckets[L+1]-1
+        offsets     nEntries+1 byte offsets of the entries in text
+        text        the entries, sorted stably by length, back to back
+
+      integers are little-endian uint64. The index is written to a temporary
+      file that is then renamed, so concurrent generators never see half of it
+    """
+    entries = [l.strip() for l in open(f)]
+    lengths = [nSegs(l) for l in entries]
+    order = sorted(range(len(entries)),key=lengths.__getitem__)
+    maxLength = max(lengths)
+    buckets = numpy.zeros(maxLength+2,dtype='<u8')
+    buckets[1:] = numpy.cumsum(numpy.bincount(lengths,minlength=maxLength+1))
+    offsets = numpy.zeros(len(entries)+1,dtype='<u8')
+    offsets[1:] = numpy.cumsum([len(entries[i]) for i in order])
+    tmpFile = "%s.%d"%(idxFile,os.getpid())
+    out = open(tmpFile,"wb")
+    out.write(dictMagic+struct.pack("<3Q",maxLength,len(entries),offsets[-1]))
+    out.write(buckets.tostring())
+    out.write(offsets.tostring())
+    out.write("".join([entries[i] for i in order]))
+    out.close()
+    os.rename(tmpFile,idxFile)
+
+def isFresh(idxFile,f):
+    """
+      whether idxFile exists and is not older than the dictionary f
+    """
+    return os.path.exists(idxFile) and os.path.getmtime(idxFile)>=os.path.getmtime(f)
+
+def defaultIndex(f):
+    """
+      where the index of dictionary f is kept unless one is given: f.idx,
+      unless that needs to be (re)compiled and the directory of f is not
+      writable, in which case it is kept in $XDG_CACHE_HOME/genCorpus (by
+      default ~/.cache/genCorpus), named after the absolute path of f, or
+      in the temporary directory if no cache directory can be created
+    """
+    idxFile = f+".idx"
+    if isFresh(idxFile,f) or os.access(os.path.dirname(os.path.abspath(idxFile)),os.W_OK):
+        return idxFile
+    name = hashlib.sha1(os.path.abspath(f)).hexdigest()+".idx"
+    cacheDir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),"genCorpus")
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        if os.access(cacheDir,os.W_OK):
+            return os.path.join(cacheDir,name)
+    except OSError:
+        pass
+    return os.path.join(tempfile.gettempdir(),name)
+
+class DictIndex(object):
+    """
+      memory-maps an index written by compileDict, so that processes
+      generating from the same dictionary share its pages
+    """
+    def __init__(self,idxFile):
+        self.data = numpy.memmap(idxFile,dtype=numpy.uint8,mode='r')
+        if self.data[:len(dictMagic)].tostring()!=dictMagic:
+            raise ValueError("%s is not a dictionary index"%idxFile)
+        pos = len(dictMagic)
+        (self.maxLength,self.nEntries,nBytes) = struct.unpack("<3Q",self.data[pos:pos+24].tostring())
+        pos += 24
+        self.buckets = self.data[pos:pos+8*(self.maxLength+2)].view('<u8')
+        pos += 8*(self.maxLength+2)
+        self.offsets = self.data[pos:pos+8*(self.nEntries+1)].view('<u8')
+        pos += 8*(self.nEntries+1)
+        self.text = self.data[pos:pos+nBytes]
+
+    def count(self,length):
+        """
+          number of entries of the given length
+        """
+        if length<1 or length>self.maxLength:
+            return 0
+        return int(self.buckets[length+1]-self.buckets[length])
+
+    def entry(self,length,i):
+        """
+          the i-th entry of the given length
+        """
+        j = int(self.buckets[length])+i
+        return self.text[self.offsets[j]:self.offsets[j+1]].tostring()
 
 class BaseDict(object):
     """
       Dict-GEO-distribution assumes a geometric distribution over word-lengths,
       uniform distribution over words at each length
     """
-    def __init__(self,dictionary,pStop=0.5):
+    def __init__(self,dictionary,pStop=0.5,idxFile=None):
         """
-        @segsC:  list of consonants
-        @segsV:  list of vowels
+        @dictionary: file listing the words, segments separated by ":"
         @pStop:  parameter of the geometric word-length distribution
+        @idxFile: compiled index of the dictionary, by default
+                  defaultIndex(dictionary)
         """
-        self.dictionary = self.initDict(dictionary)
+        self.dictionary = self.initDict(dictionary,idxFile or defaultIndex(dictionary))
         self.pStop = pStop
-        self.maxLength = max(self.dictionary.keys())
-
-    def initDict(self,f):
-        res = {}
-        for l in open(f):
-            l = l.strip()
-            length = len(l.split(":"))
-            x = res.get(length,[])
-            x.append(l)
-            res[length] = x
-        return res
+        self.maxLength = self.dictionary.maxLength
+
+    def initDict(self,f,idxFile):
+        if not isFresh(idxFile,f):
+            compileDict(f,idxFile)
+        return DictIndex(idxFile)
 
     def predProb(self,obs):
-        length = len(obs.split(":"))
+        length = nSegs(obs)
         res = (1-self.pStop)**length * self.pStop/(1-self.pStop)
-        counts = self.dictionary.get(length,0)
+        counts = self.dictionary.count(length)
         if counts == 0:
             return 0
         else:
             return res*1/float(counts)
 
+    def predProbs(self,obs):
+        """
+          predProb of each observation in the list obs, as an array
+        """
+        lengths = numpy.array([nSegs(o) for o in obs])
+        counts = numpy.diff(self.dictionary.buckets.astype(float))[numpy.minimum(lengths,self.maxLength)]
+        counts[lengths>self.maxLength] = 0
+        res = (1-self.pStop)**lengths * self.pStop/(1-self.pStop)
+        return numpy.where(counts>0,res/numpy.maximum(counts,1),0.0)
+
     def sample(self):
+        # the number of failures before the first stop is floor(log(u)/log(1-pStop))
         i = 1
-        while random.random()<(1-self.pStop) and i<self.maxLength:
-            i+=1
-        return random.choice(self.dictionary[i])
+        if self.pStop<1:
+            i = min(1+int(math.log(1-random.random())/math.log(1-self.pStop)),self.maxLength)
+        counts = self.dictionary.count(i)
+        if counts == 0:
+            raise ValueError("no words of length %d in the dictionary"%i)
+        return self.dictionary.entry(i,int(random.random()*counts))
+
+
+class Fenwick(object):
+    """
+      binary indexed tree over a growing list of non-negative weights,
+      with O(log n) updates and O(log n) sampling proportional to weight
+    """
+    def __init__(self):
+        self.weights = []
+        self.capacity = 1
+        self.tree = [0.0,0.0]
+        self.total = 0.0
+
+    def append(self,w):
+        """
+        @w:      weight of the new last item, whose index is returned
+        """
+        if len(self.weights)==self.capacity:
+            self.capacity *= 2
+            self.tree = [0.0]+self.weights+[0.0]*(self.capacity-len(self.weights))
+            for i in range(1,self.capacity+1):
+                j = i+(i&-i)
+                if j<=self.capacity:
+                    self.tree[j] += self.tree[i]
+        self.weights.append(0.0)
+        self.add(len(self.weights)-1,w)
+        return len(self.weights)-1
 
+    def add(self,i,delta):
+        self.weights[i] += delta
+        self.total += delta
+        tree, capacity = self.tree, self.capacity
+        i += 1
+        while i<=capacity:
+            tree[i] += delta
+            i += i&-i
+
+    def find(self,u):
+        """
+          index of the item whose cumulative weight interval contains u,
+          for 0 <= u < total
+        """
+        tree, capacity = self.tree, self.capacity
+        pos = 0
+        step = capacity
+        while step:
+            if pos+step<=capacity and tree[pos+step]<=u:
+                pos += step
+                u -= tree[pos]
+            step >>= 1
+        return min(pos,len(self.weights)-1)
+
+    def sample(self):
+        return self.find(random.random()*self.total)
 
 class DP(object):
+    """
+      Pitman-Yor restaurant: word w has weight n_w-a*t_w (its count minus the
+      discount times its number of tables) in a Fenwick tree over the types,
+      and each word's tables are a list of table sizes together with an array
+      giving the table of each of its customers
+    """
     def __init__(self,base,a=0.0,b=200.0):
         self.base = base
         self.a = a
         self.b = b
         self.counts = {}
+        self.seating = {}
+        self.typeIndex = {}
+        self.types = []
+        self.weights = Fenwick()
         self.obs = 0
         self.tables = 0
     
     def add(self,obs):
         newTable = self.pNewTable(obs)
         oldTable = self.pOldTable(obs)
-        self.obs+=1
         if random.random()<=newTable/(newTable+oldTable):
-            self.addNewTable(obs)
-            self.tables+=1
+            self.addToNewTable(obs)
         else:
             self.addToOldTable(obs)
 
     def pNewTable(self,obs):
         return (self.b+self.a*self.tables)*self.base.predProb(obs)
 
+    def pNewTables(self,obs):
+        """
+          pNewTable of each observation in the list obs, as an array
+        """
+        return (self.b+self.a*self.tables)*self.base.predProbs(obs)
+
     def pOldTable(self,obs):
         try:
             return self.counts[obs][0]-self.a*len(self.counts[obs][1])
         except KeyError:
-            0.0
+            return 0.0
 
     def pNewTableS(self):
         return (self.b+self.a*self.tables)
@@ -178,21 +396,35 @@ class DP(object):
     def addToNewTable(self,obs):
         try:
             oldCounts, tables = self.counts[obs]
+            self.seating[obs].append(len(tables))
             tables.append(1)
             self.counts[obs][0] = oldCounts+1
-        except:
+            self.weights.add(self.typeIndex[obs],1-self.a)
+        except KeyError:
             self.counts[obs] = [1,[1]]
+            self.seating[obs] = array('i',[0])
+            self.typeIndex[obs] = self.weights.append(1-self.a)
+            self.types.append(obs)
+        self.obs+=1
+        self.tables+=1
 
     def addToOldTable(self,obs):
-        whichTable = random.randint(1,self.counts[obs][0])
-        i = -1
-        cur = 0
+        """
+          seats obs at one of its tables, chosen proportionally to n_k-a: a
+          table chosen through a random customer (proportionally to n_k) is
+          kept with probability (n_k-a)/n_k
+        """
         tables = self.counts[obs][1]
-        while whichTable<=cur:
-            i+=1
-            cur += tables[i]
+        seating = self.seating[obs]
+        while True:
+            i = seating[int(random.random()*len(seating))]
+            if self.a==0 or random.random()*tables[i]<tables[i]-self.a:
+                break
         tables[i]+=1
+        seating.append(i)
         self.counts[obs][0]+=1
+        self.weights.add(self.typeIndex[obs],1)
+        self.obs+=1
     
     def sampleWord(self):
         newWord = self.pNewTableS()
@@ -200,18 +432,11 @@ class DP(object):
         if random.random()<=newWord/(newWord+oldWord):
             word = self.base.sample()
             self.addToNewTable(word)
-            self.obs+=1
-            self.tables+=1
             return word
         else:
-            whichTable = random.randint(1,self.obs)
-            cur = 0
-            for word in self.counts.keys():
-                cur += self.counts[word][0]
-                if whichTable<=cur:
-                    self.addToOldTable(word)
-                    self.obs+=1
-                    return word
+            word = self.types[self.weights.sample()]
+            self.addToOldTable(word)
+            return word
 
     def sampleSentence(self,stopProb=1/3.0):
         res = [self.sampleWord()]
@@ -228,8 +453,14 @@ if __name__=="__main__":
     parser.add_argument("-m",help="mean length of words",type=float,default=3)
     parser.add_argument("-M",help="mean length of utterances",type=float,default=3)
     parser.add_argument("-d",help="dictionary to use")
+    parser.add_argument("-i",help="compiled index of the dictionary (default: <dict>.idx, or under ~/.cache/genCorpus if that directory is not writable)")
+    parser.add_argument("-s",help="random seed",type=int)
     args = parser.parse_args()
 
+    if args.s is not None:
+        random.seed(args.s)
+        numpy.random.seed(args.s)
+
     N = args.N
     base = args.base
     conc = args.b
@@ -242,7 +473,7 @@ if __name__=="__main__":
     elif base=="cv":
         baseDist = BaseGeoCV(pStop=1/(meanWord/2.0))
     elif base=="dict":
-        baseDist = BaseDict(args.d,pStop=1/float(meanWord))
+        baseDist = BaseDict(args.d,pStop=1/float(meanWord),idxFile=args.i)
     crp = DP(baseDist,disc,conc)
     for i in range(N):
         print crp.sampleSentence(1.0/meanUtt)
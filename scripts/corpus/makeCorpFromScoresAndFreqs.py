@@ -3,7 +3,7 @@
 import argparse
 import sys
 import math
-import bisect, random
+import heapq, random
 
 parser = argparse.ArgumentParser(description = 'Generate a corpus from the output of a maxent grammar and with a specified frequency distribution')
 #parser.add_argument('scoreFile', help='Tab-delimited file with word string first and disharmony last')
@@ -12,6 +12,12 @@ parser.add_argument('-o', '--outputFile', default='corpus.txt', help='Name of ou
 parser.add_argument('-l', '--lexFile', help='Name of lexicon file to output (optional)')
 parser.add_argument('-m', '--minHarmony', type=float, default = -25.0, help='Do not consider words with disharmony <= m')
 parser.add_argument('-p', '--probUttBound', type=float, default = 0.333, help='Probability of utterance boundary')
+parser.add_argument('-s', '--stream', action='store_true', help='Assemble and write the corpus in blocks of tokens, without building it in memory')
+parser.add_argument('-b', '--blockSize', type=int, default=100000, help='Number of tokens per block with --stream')
+## instead of reading scores, words can be drawn straight from a grammar
+parser.add_argument('-g', '--grammar', help='Sample words from this grammar of n-gram constraints instead of reading scores from stdin')
+parser.add_argument('-F', '--featureFile', default='pakna_feats.txt', help='Feature file for the grammar')
+parser.add_argument('-L', '--maxLen', type=int, default=6, help='Maximum number of segments in a word sampled from the grammar')
 args = parser.parse_args()
 
 ## Read in frequency distribution
@@ -23,42 +29,116 @@ with open(args.freqFile) as fin:
         if parse: freqDist.append(int(parse[0]))
 nTypes = len(freqDist)
 
-## Read in score file and set up sampler
-sys.stderr.write('Reading in scores from stdin and setting up sampler\n')
-words, fmass = [], [0]
-for line in sys.stdin:
-    parse = line.strip().split('\t')
-    word, disharmony = parse[0], float(parse[-1])
-    if disharmony <= args.minHarmony: continue
-    words.append(word)
-    fmass.append(fmass[-1]+math.exp(disharmony))
+if args.grammar:
+    ## Compile the grammar into a weighted automaton
+    sys.stderr.write('Compiling %s into a sampler\n' %args.grammar)
+    from maxent import FeatureSet, Grammar, LexiconSampler
+    sampler = LexiconSampler(Grammar(args.grammar), \
+                             FeatureSet(args.featureFile), args.maxLen)
+
+    ## Generate/sample words
+    sys.stderr.write('Generating/sampling words\n')
+    newwords, seen = [], set()
+    while len(newwords) < nTypes:
+        newword = sampler.sample(args.minHarmony)
+        if newword not in seen:
+            newwords.append(newword)
+            seen.add(newword)
+else:
+    ## Sample words in one pass over the score stream (Efraimidis and
+    ## Spirakis 2006): each word gets the key u**(1/exp(disharmony)) for
+    ## uniform u, and the nTypes words with the largest keys, in decreasing
+    ## order of key, are distributed like nTypes successive draws in
+    ## proportion to exp(disharmony) that reject repeats. The keys are
+    ## compared as disharmony - log(-log(u)), which orders them the same
+    ## way without underflowing, and the best nTypes are kept in a heap.
+    sys.stderr.write('Sampling words from the scores on stdin\n')
+    reservoir = []
+    for line in sys.stdin:
+        parse = line.strip().split('\t')
+        word, disharmony = parse[0], float(parse[-1])
+        if disharmony <= args.minHarmony: continue
+        key = disharmony - math.log(random.expovariate(1.0))
+        if len(reservoir) < nTypes:
+            heapq.heappush(reservoir, (key, word))
+        elif key > reservoir[0][0]:
+            heapq.heapreplace(reservoir, (key, word))
+    if len(reservoir) < nTypes:
+        raise ValueError, 'Only %d words above the harmony floor, %d needed' \
+                %(len(reservoir), nTypes)
+    newwords = [word for key, word in sorted(reservoir, reverse=True)]
 
-## Generate/sample words
-sys.stderr.write('Generating/sampling words\n')
-newwords = []
-while len(newwords) < nTypes:
-    r = random.random()*fmass[-1]
-    i = bisect.bisect_right(fmass, r)-1
-    newword = words[i]
-    if newword not in newwords: newwords.append(newword)
 if args.lexFile:
     with open(args.lexFile,'w') as fout:
         for i in range(nTypes): fout.write('%s\t%d\n' %(newwords[i],freqDist[i]))
 
-## Generate corpus by permuting words
-sys.stderr.write('Generating corpus by permuting words\n')
-corpus = []
-for i in range(nTypes): corpus.extend(freqDist[i]*[newwords[i]])
-random.shuffle(corpus)
+def tokenBlocks(counts, blockSize):
+    """Yields the type indices of a random permutation of a corpus with the
+    given type counts, blockSize tokens at a time. The types in each block
+    are one multivariate hypergeometric draw from the remaining counts,
+    made as a sequence of univariate draws, and are then shuffled, which
+    gives each block the distribution of a slice of a shuffled corpus."""
+    counts = numpy.array(counts, dtype=numpy.int64)
+    remaining = counts.sum()
+    while remaining > 0:
+        nDraw = need = min(blockSize, remaining)
+        draw = numpy.zeros(len(counts), dtype=numpy.int64)
+        left = remaining
+        for i in numpy.flatnonzero(counts):
+            if need == 0: break
+            left -= counts[i]
+            if left == 0: draw[i] = need
+            else: draw[i] = numpy.random.hypergeometric(counts[i], left, need)
+            need -= draw[i]
+        counts -= draw
+        remaining -= nDraw
+        block = numpy.repeat(numpy.arange(len(counts)), draw)
+        numpy.random.shuffle(block)
+        yield block
+
+def uttLengths(probUttBound, batchSize):
+    """Yields utterance lengths, drawn in batches: an utterance continues
+    after each word with probability 1-probUttBound, as in the loop over
+    random.random() below, and empty utterances are skipped"""
+    while True:
+        lengths = numpy.random.geometric(probUttBound, batchSize)-1
+        for length in lengths[lengths > 0]: yield length
+
+if args.stream:
+    ## Generate and output corpus block by block
+    sys.stderr.write('Generating and outputting corpus in blocks of %d tokens\n' \
+                     %args.blockSize)
+    import numpy
+    lengths = uttLengths(args.probUttBound, args.blockSize)
+    with open(args.outputFile,'w') as fout:
+        buf, need = [], next(lengths)
+        for block in tokenBlocks(freqDist, args.blockSize):
+            lines, pos = [], 0
+            while pos < len(block):
+                take = min(need-len(buf), len(block)-pos)
+                buf.extend(block[pos:pos+take])
+                pos += take
+                if len(buf) == need:
+                    lines.append(' # '.join([newwords[i] for i in buf])+'\n')
+                    buf, need = [], next(lengths)
+            fout.write(''.join(lines))
+        ## the corpus may run out in the middle of an utterance
+        if buf: fout.write(' # '.join([newwords[i] for i in buf])+'\n')
+else:
+    ## Generate corpus by permuting words
+    sys.stderr.write('Generating corpus by permuting words\n')
+    corpus = []
+    for i in range(nTypes): corpus.extend(freqDist[i]*[newwords[i]])
+    random.shuffle(corpus)
 
-## Output corpus
-sys.stderr.write('Outputting corpus')
-with open(args.outputFile,'w') as fout:
-    while corpus:
-        buf = []
-        while random.random() >= args.probUttBound:
-            try: buf.append(corpus.pop())
-            except IndexError: pass
-        if buf: fout.write(' # '.join(buf)+'\n')
+    ## Output corpus
+    sys.stderr.write('Outputting corpus')
+    with open(args.outputFile,'w') as fout:
+        while corpus:
+            buf = []
+            while random.random() >= args.probUttBound:
+                try: buf.append(corpus.pop())
+                except IndexError: pass
+            if buf: fout.write(' # '.join(buf)+'\n')
 
 
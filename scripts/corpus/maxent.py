@@ -6,8 +6,9 @@
 ######################################################################
 ######################################################################
 
-import sys
-import re, math
+import os, sys
+import re, math, itertools, bisect, random, multiprocessing
+import numpy
 import scipy, scipy.sparse, scipy.optimize
 
 class FeatureSet:
@@ -68,6 +69,11 @@ class FeatureSet:
 --->    self.natclasses <dict>
             key: tuple containing all segments in the natural class
             value: featspec which specified the class
+    Each segment is a bit position (in sorted segment order) and each
+    feature value the bitmask of the segments that bear it, so a
+    featspec's extension is the AND of its values' masks. The classes
+    are also indexed by mask in self.maskclasses (mask -> featspec)
+    and by segment in self.segclassIndex (seg -> classes containing it).
     In general, PhoMEnt refers to natural classes with a string
     that is in one-to-one correspondence with the featspec.
     
@@ -94,6 +100,14 @@ class FeatureSet:
         self.segdict = {}
         self.featdict = {}
         self.natclasses = {}
+        self.bitsegs = ()
+        self.segbits = {}
+        self.featmasks = {}
+        self.fullmask = 0
+        self.maskclasses = {}
+        self.segclassIndex = {}
+        self.segprefixes = {}
+        self.segsAligned = True
         if featfile:
             self.readFeatures(featfile)
             self.getclasses()
@@ -113,6 +127,47 @@ class FeatureSet:
                 self.featdict[(self.features[iFeat],featval)] = sorted( \
                     self.featdict.get((self.features[iFeat],featval),[])+[seg])
         fin.close()
+        self.indexSegments()
+
+    def indexSegments(self):
+        """Assigns each segment a bit, in sorted order, and each feature
+        value the bitmask of the segments that bear it."""
+        self.bitsegs = tuple(sorted(self.segments))
+        self.segbits = dict([(seg, 1 << i) \
+                for i, seg in enumerate(self.bitsegs)])
+        self.fullmask = (1 << len(self.bitsegs)) - 1
+        self.featmasks = {}
+        for featval in self.featdict:
+            mask = 0
+            for seg in self.featdict[featval]: mask |= self.segbits[seg]
+            self.featmasks[featval] = mask
+        ## a regex alternative can match the start of a longer segment
+        ## ('N' in 'NG'); any other overlap between segment strings would
+        ## let a match begin inside a segment
+        self.segprefixes = dict([(seg, [other for other in self.segments \
+                if other != seg and seg.startswith(other)]) \
+                for seg in self.segments])
+        self.segsAligned = not any(other != seg and seg.find(other, 1) >= 0 \
+                for seg in self.segments for other in self.segments)
+
+    def featmask(self, item):
+        'Bitmask of the segments with feature value item = (index, value)'
+        return(self.featmasks.get((self.features[item[0]],item[1]),0))
+
+    def getmask(self, featspec):
+        'Bitmask of the segments that match a featural specification.'
+        mask = self.fullmask
+        for item in featspec: mask &= self.featmask(item)
+        return(mask)
+
+    def mask2segs(self, mask):
+        'Sorted tuple of the segments whose bits are set in mask'
+        segs = []
+        while mask:
+            low = mask & -mask
+            segs.append(self.bitsegs[low.bit_length()-1])
+            mask ^= low
+        return(tuple(segs))
 
     def uppertriang(self, featspec):
         """ For enumeration. If input featspec specifies [+FeatureI,-FeatureJ],
@@ -134,15 +189,30 @@ class FeatureSet:
         This function searches all featspecs in an order designed to allow for
             efficient paring of redundant featspecs. """
         self.natclasses[tuple(self.segments)] = []
-        nextspecs = [[(i,'+')] for i in range(len(self.features))] + \
-                [[(i,'-')] for i in range(len(self.features))]
+        ## the full class is keyed in file order, so it only blocks the
+        ## featspecs that pick out every segment if the file is sorted
+        if tuple(self.segments) == self.bitsegs:
+            self.maskclasses[self.fullmask] = []
+        nextspecs = [([(i,'+')], self.featmask((i,'+'))) \
+                        for i in range(len(self.features))] + \
+                    [([(i,'-')], self.featmask((i,'-'))) \
+                        for i in range(len(self.features))]
         while nextspecs:
             featspecs, nextspecs = nextspecs, []
-            for featspec in featspecs:
-                natclass = tuple(sorted(self.getclass(featspec)))
-                if natclass in self.natclasses or not natclass: continue
-                self.natclasses[natclass] = featspec
-                nextspecs += self.uppertriang(featspec)
+            for featspec, mask in featspecs:
+                if not mask or mask in self.maskclasses: continue
+                self.maskclasses[mask] = featspec
+                self.natclasses[self.mask2segs(mask)] = featspec
+                nextspecs += [(nextspec, mask & self.featmask(nextspec[-1])) \
+                        for nextspec in self.uppertriang(featspec)]
+        self.indexclasses()
+
+    def indexclasses(self):
+        'Indexes the natural classes by the segments they contain'
+        self.segclassIndex = {}
+        for natclass in self.natclasses:
+            for seg in natclass:
+                self.segclassIndex.setdefault(seg, {})[natclass] = 1
 
     def featspec2str(self, featspec):
         'Generates a string representation of the inputted featspec'
@@ -174,28 +244,15 @@ class FeatureSet:
         with open(infile) as fin:
             for line in fin:
                 self.natclasses[tuple(line.split())] = 1
-
+        self.indexclasses()
 
     def getclass(self, featspec):
         'Return the segs that match a featural specification.'
-        cur = self.segments
-        for item in featspec: cur = self.intersect(cur, \
-                self.featdict.get((self.features[item[0]],item[1]),[]))
-        return(sorted(cur))
-    
-    def intersect(self, dict1, dict2):
-        'Get keys that are in both dict1 and dict2'
-        intersection = {}
-        for key in dict1:
-            if key in dict2: intersection[key] = 1
-        return(intersection)
+        return(list(self.mask2segs(self.getmask(featspec))))
 
     def segclasses(self, seg):
         'Get all natural classes to which seg belongs'
-        classes = {}
-        for natclass in self.natclasses:
-            if seg in natclass: classes[natclass] = 1
-        return(classes)
+        return(dict(self.segclassIndex.get(seg, {})))
     
     def getNatClass2FeatureStrDict(self):
         return(dict([(segTuple,self.featspec2str(self.natclasses[segTuple])) \
@@ -227,38 +284,76 @@ def getBlocks(parsed, blockLen):
         blocks.append(wholeSeq[iPos:iPos+blockLen])
     return(blocks)
 
-def badNeighbors(trainCts, segments):
-    neighbors, trigrams = {}, {}
-    for form in trainCts:
+def observedTrigrams(forms):
+    'Set of the trigrams (padded with #) of the space-separated forms'
+    trigrams = set()
+    for form in forms:
+        trigrams.update(getBlocks(tuple(form.split()),3))
+    return(trigrams)
+
+def iterBadNeighbors(forms, segments, trigrams):
+    """Yields, once each, the deletion, substitution and insertion
+    neighbors of the forms that contain a trigram missing from trigrams.
+
+    An edit at position iPos only changes the trigrams that overlap it;
+    the others are trigrams of the form itself, so each neighbor is
+    checked as soon as it is built, on the padded segments around iPos.
+    Only the neighbors that pass are kept, to skip their repeats."""
+    seen = set()
+    for form in forms:
         ## stored as string, but processed as tuple
         parsed = tuple(form.split())
-        ## get observed trigrams
-        for triBlock in getBlocks(parsed,3):
-            trigrams[triBlock] = trigrams.get(triBlock,0)+1
-        ## add deletion, mutation, and insertion neighbors
         for iPos in range(len(parsed)):
-            neighbors[parsed[:iPos]+parsed[iPos+1:]] = 1
+            edits = [parsed[:iPos]+parsed[iPos+1:]]
             for seg in segments:
-                neighbors[parsed[:iPos]+(seg,)+parsed[iPos+1:]]=1
-                neighbors[parsed[:iPos]+(seg,)+parsed[iPos:]]=1
-    ## delete the empty neighbor
-    try: del neighbors[()]
-    except KeyError: pass
-    ## delete neighbors containing only trained trigrams
-    for neighbor in neighbors.keys():
-        allBlocksSeen = True
-        for triBlock in getBlocks(neighbor,3):
-            if triBlock not in trigrams: allBlocksSeen = False
-        if allBlocksSeen: del neighbors[neighbor]
-    return(sorted([' '.join(nbr) for nbr in neighbors]))
+                edits.append(parsed[:iPos]+(seg,)+parsed[iPos+1:])
+                edits.append(parsed[:iPos]+(seg,)+parsed[iPos:])
+            for neighbor in edits:
+                if not neighbor: continue
+                local = (('#',)+neighbor+('#',))[max(iPos-1,0):iPos+4]
+                if all(local[i:i+3] in trigrams \
+                        for i in range(len(local)-2)): continue
+                nbStr = ' '.join(neighbor)
+                if nbStr in seen: continue
+                seen.add(nbStr)
+                yield(nbStr)
+
+## the trigrams and segments shared by badNeighbors' worker processes
+_neighborState = None
+
+def _initNeighbors(segments, trigrams):
+    global _neighborState
+    _neighborState = (segments, trigrams)
+
+def _shardNeighbors(forms):
+    segments, trigrams = _neighborState
+    return(list(iterBadNeighbors(forms, segments, trigrams)))
+
+def badNeighbors(trainCts, segments, jobs=1):
+    """Sorted list of the string edit neighbors of the training forms that
+    contain an unobserved trigram (see iterBadNeighbors). With jobs > 1,
+    the forms are sharded over that many worker processes."""
+    trigrams = observedTrigrams(trainCts)
+    if jobs <= 1:
+        return(sorted(iterBadNeighbors(trainCts, segments, trigrams)))
+    forms = list(trainCts)
+    nShards = 4*jobs
+    pool = multiprocessing.Pool(jobs, _initNeighbors, (segments, trigrams))
+    neighbors = set()
+    for shard in pool.imap_unordered(_shardNeighbors, \
+            [forms[iShard::nShards] for iShard in range(nShards)]):
+        neighbors.update(shard)
+    pool.close()
+    pool.join()
+    return(sorted(neighbors))
 
 
 
 class Grammar:
     def __init__(self, gramFile = None):
-        if gramFile: self.loadFromFile(gramFile)
         self.weights = None
         self.constraints = None
+        if gramFile: self.loadFromFile(gramFile)
     
     def loadFromFile(self, gramFile):
         self.constraints = []
@@ -287,59 +382,573 @@ class Registry:
                     %conStr + '; returning constant function (0)'
             return(lambda word: 0)
             
+##############################################################################
+##  N-GRAM INDEX
+##############################################################################
+##
+##  An Ngram constraint that is just a sequence of natural classes, e.g.
+##  'Ngram:^[+syl] [-syl]', counts the segment n-grams of a word that fall
+##  in the product of its classes. Words are tokenised once into counts of
+##  anchored n-grams (tuples of segments, with '#' marking a word edge),
+##  each constraint is compiled into the set of n-grams it penalizes, and
+##  the whole violation matrix is the sparse product of the two.
+##
+##  The counts are those of the regular expressions built by
+##  Registry.interpret, whose findall only counts matches that do not
+##  overlap: 'Ngram:[-syl] [-syl]' assigns 'P T K' one violation, not two.
+##  The n-grams of a constraint whose matches can overlap are therefore
+##  counted left to right, skipping any that start inside the previous
+##  match. The last class of a constraint without a '$' anchor also
+##  matches a segment that begins with one of its members, as the regex
+##  matches the 'N' of 'NG'. These counts are only exact when no segment
+##  occurs inside another except as a prefix (FeatureSet.segsAligned);
+##  otherwise every constraint is evaluated with its regex.
+
+ngramConRE = re.compile(r'^(\^?)((?:\[[^\]]*\] )*\[[^\]]*\])(\$?)$')
+
+def parseNgramCon(feats, conStr):
+    """Returns (shape, classes) for a constraint that is a sequence of
+    natural classes, where shape is (initial, n, final) and classes lists
+    the segments of each class, or None for any other constraint. Unless
+    the constraint is '$'-anchored, its last class is extended with the
+    segments that begin with one of its members."""
+    family, conRE = conStr.split(':')
+    if family != 'Ngram' or not feats.segsAligned: return(None)
+    match = ngramConRE.match(conRE)
+    if not match: return(None)
+    classes = [feats.featureStr2segList(classStr[1:-1]) \
+                for classStr in match.group(2).split(' ')]
+    if not all(classes): return(None)
+    final = bool(match.group(3))
+    if not final:
+        last = set(classes[-1])
+        classes[-1] = sorted(last | set([seg for seg in feats.segments \
+                if last.intersection(feats.segprefixes[seg])]))
+    return((bool(match.group(1)), len(classes), final), classes)
+
+def selfOverlaps(shape, classes):
+    """True if two matches of the n-gram constraint with this shape and
+    classes can overlap, so that counting its n-grams without overlaps
+    differs from counting all of them"""
+    initial, n, final = shape
+    if initial or final: return(False)
+    sets = [set(segList) for segList in classes]
+    for shift in range(1, n):
+        if all(sets[shift+i] & sets[i] for i in range(n-shift)): return(True)
+    return(False)
+
+def shapeNgrams(parsed, shape):
+    'Returns the n-grams of the segment tuple parsed with the given shape'
+    initial, n, final = shape
+    if len(parsed) < n: return([])
+    if initial and final:
+        if len(parsed) > n: return([])
+        return([('#',)+parsed+('#',)])
+    if initial: return([('#',)+parsed[:n]])
+    if final: return([parsed[-n:]+('#',)])
+    return([parsed[i:i+n] for i in range(len(parsed)-n+1)])
+
+def ngramViolations(registry, conOrder, wordOrder):
+    """Returns the words x constraints violation matrix (a scipy.sparse
+    csc_matrix with sorted indices) of the constraints in conOrder on the
+    words in wordOrder. Constraints that parseNgramCon cannot handle are
+    evaluated with their Registry function."""
+    parsedCons = [parseNgramCon(registry.feats, conStr) for conStr in conOrder]
+    scanned = [bool(parsed) and selfOverlaps(*parsed) for parsed in parsedCons]
+    shapes = sorted(set(parsed[0] for parsed, scan in \
+                zip(parsedCons, scanned) if parsed and not scan))
+    scanLens = sorted(set(parsed[0][1] for parsed, scan in \
+                zip(parsedCons, scanned) if scan))
+
+    ## words x n-grams counts, and the n-grams that occur of the lengths of
+    ## the constraints whose matches can overlap
+    ngramIndex, scanNgrams = {}, set()
+    parsedWords = []
+    rowVec, colVec = [], []
+    for iWord, word in enumerate(wordOrder):
+        parsed = tuple(word.split())
+        parsedWords.append(parsed)
+        for shape in shapes:
+            for ngram in shapeNgrams(parsed, shape):
+                rowVec.append(iWord)
+                colVec.append(ngramIndex.setdefault(ngram, len(ngramIndex)))
+        for n in scanLens:
+            scanNgrams.update(parsed[i:i+n] for i in range(len(parsed)-n+1))
+    wordNgrams = scipy.sparse.coo_matrix((scipy.ones(len(rowVec), dtype=int), \
+                (rowVec, colVec)), shape=(len(wordOrder), len(ngramIndex)), \
+                dtype=int).tocsr()
+
+    ## n-grams x constraints membership; other constraints evaluated directly
+    rowVec, colVec = [], []
+    fbRows, fbCols, fbVals = [], [], []
+    scanCons = {}
+    for jCon, parsed in enumerate(parsedCons):
+        if scanned[jCon]:
+            for ngram in itertools.product(*parsed[1]):
+                if ngram in scanNgrams:
+                    scanCons.setdefault(ngram, []).append(jCon)
+        elif parsed:
+            (initial, n, final), classes = parsed
+            for segs in itertools.product(*classes):
+                ngram = ('#',)*initial + segs + ('#',)*final
+                if ngram in ngramIndex:
+                    rowVec.append(ngramIndex[ngram])
+                    colVec.append(jCon)
+        else:
+            con = registry.interpret(conOrder[jCon])
+            for iWord, word in enumerate(wordOrder):
+                nViols = con(word)
+                if nViols:
+                    fbRows.append(iWord)
+                    fbCols.append(jCon)
+                    fbVals.append(nViols)
+    ## overlapping matches are counted left to right, like findall
+    for iWord, parsed in enumerate(parsedWords):
+        lastEnd = {}
+        for i in range(len(parsed)):
+            for n in scanLens:
+                for jCon in scanCons.get(parsed[i:i+n], ()):
+                    if i >= lastEnd.get(jCon, 0):
+                        lastEnd[jCon] = i+n
+                        fbRows.append(iWord)
+                        fbCols.append(jCon)
+                        fbVals.append(1)
+    ngramCons = scipy.sparse.coo_matrix((scipy.ones(len(rowVec), dtype=int), \
+                (rowVec, colVec)), shape=(len(ngramIndex), len(conOrder)), \
+                dtype=int).tocsc()
+    violMat = (wordNgrams * ngramCons).tocsc()
+    if fbVals:
+        violMat = violMat + scipy.sparse.coo_matrix((fbVals, (fbRows, fbCols)), \
+                shape=violMat.shape, dtype=int).tocsc()
+    violMat.sort_indices()
+    return(violMat)
+
+def splitNgramCons(feats, conStrs):
+    """Sorts the constraints in conStrs by where their violations are
+    resolved: returns (prefixCons, finalCons, others), where prefixCons
+    and finalCons list (jCon, initial, n, classes) for the n-gram
+    constraints without and with a '$' anchor, and others lists the
+    indices of the constraints that parseNgramCon cannot handle."""
+    prefixCons, finalCons, others = [], [], []
+    for jCon, conStr in enumerate(conStrs):
+        parsed = parseNgramCon(feats, conStr)
+        if not parsed:
+            others.append(jCon)
+            continue
+        (initial, n, final), classes = parsed
+        con = (jCon, initial, n, [set(segList) for segList in classes])
+        if final: finalCons.append(con)
+        else: prefixCons.append(con)
+    return(prefixCons, finalCons, others)
+
+def violatedCons(cons, length, ngram):
+    """Constraints in cons violated by the n-gram of segments ending ngram,
+    the last segments of a prefix of the given length"""
+    return([jCon for (jCon, initial, n, classes) in cons \
+            if length >= n and (not initial or length == n) \
+            and all(seg in segs for seg, segs in zip(ngram[-n:], classes))])
+
+def enumerateViolations(registry, conStrs, maxLen, weights=None, floor=None, \
+                        minLen=1, root=()):
+    """Yields (form, viols) for every string of minLen to maxLen segments
+    of the FeatureSet that starts with the segments in root, in the order
+    in which make_pakna.py writes them, where viols lists the violations
+    of each constraint in conStrs.
+
+    The strings of each length are enumerated depth-first over their
+    prefixes. The violations of unanchored and '^'-anchored n-gram
+    constraints are updated as each segment is appended, and those of
+    '$'-anchored ones are added at the end of the string; the n-grams are
+    counted as in ngramViolations, so that a constraint whose matches can
+    overlap is not counted again until the previous match has ended, and
+    every count equals that of the constraint's regex. Constraints that parseNgramCon cannot
+    handle are evaluated on each string with their Registry function.
+
+    Given the constraint weights and a harmony floor, a prefix is not
+    extended once its harmony is <= floor. This needs all weights to be
+    non-positive: violations only accumulate as a prefix is extended, so
+    its harmony bounds that of every string it starts. Strings that are
+    yielded may still fall below the floor at their last segment."""
+    if floor is not None and max(weights) > 0:
+        raise ValueError, 'Cannot prune with positive constraint weights'
+    segments = registry.feats.segments
+    prefixCons, finalCons, others = splitNgramCons(registry.feats, conStrs)
+    fallback = [(jCon, registry.interpret(conStrs[jCon])) for jCon in others]
+    prefixWin = max([n for (jCon, initial, n, classes) in prefixCons] or [0])
+    overlapLen = dict([(jCon, n) for (jCon, initial, n, classes) in prefixCons \
+                if selfOverlaps((initial, n, False), classes)])
+    finalWin = max([n for (jCon, initial, n, classes) in finalCons] or [0])
+
+    ## which constraints an n-gram violates only depends on the last few
+    ## segments and on whether the string is shorter than that
+    appendCache, finalCache = {}, {}
+    counts = [0]*len(conStrs)
+    ## length of the prefix at the end of each constraint's last match
+    lastEnd = [0]*len(conStrs)
+
+    def cacheKey(prefix, window):
+        return((min(len(prefix), window+1), prefix[max(len(prefix)-window,0):]))
+
+    def harmony():
+        ## summed in the same order as the test output, so that rounding
+        ## cannot make the bound fall below a string's reported harmony
+        H = 0.0
+        for jCon, nViols in enumerate(counts):
+            H += weights[jCon]*nViols
+        return(H)
+
+    def walk(prefix, form, length):
+        key = cacheKey(prefix, prefixWin)
+        try: violated = appendCache[key]
+        except KeyError:
+            violated = appendCache[key] = violatedCons(prefixCons, len(prefix), prefix)
+        counted, ended = [], []
+        for jCon in violated:
+            if jCon in overlapLen:
+                if len(prefix) - overlapLen[jCon] < lastEnd[jCon]: continue
+                ended.append((jCon, lastEnd[jCon]))
+                lastEnd[jCon] = len(prefix)
+            counts[jCon] += 1
+            counted.append(jCon)
+        if len(prefix) == length:
+            key = cacheKey(prefix, finalWin)
+            try: violatedFinal = finalCache[key]
+            except KeyError:
+                violatedFinal = finalCache[key] = violatedCons(finalCons, len(prefix), prefix)
+            viols = counts[:]
+            for jCon in violatedFinal: viols[jCon] += 1
+            for jCon, con in fallback: viols[jCon] = con(form)
+            yield (form, viols)
+        elif floor is None or harmony() > floor:
+            if len(prefix) < len(root): nextSegs = [root[len(prefix)]]
+            else: nextSegs = segments
+            for seg in nextSegs:
+                for result in walk(prefix+(seg,), form+' '+seg, length):
+                    yield result
+        for jCon in counted: counts[jCon] -= 1
+        for jCon, end in ended: lastEnd[jCon] = end
+
+    for length in range(max(minLen, len(root), 1), maxLen+1):
+        for seg in root[:1] or segments:
+            for result in walk((seg,), seg, length):
+                yield result
+
+def scoreLines(scored, weights, floor=None):
+    """Yields the test output line 'form<tab>violations...<tab>harmony' of
+    each (form, viols) in scored, skipping forms whose harmony is <= floor.
+    Lines are formatted as they are scored, so memory use does not grow
+    with the number of forms."""
+    for form, viols in scored:
+        H = 0.0
+        for jCon, nViols in enumerate(viols):
+            H += weights[jCon]*nViols
+        if floor is not None and H <= floor: continue
+        yield('\t'.join([form]+map(str,viols)+['%f' %H])+'\n')
+
+##############################################################################
+##  VIOLATION STORE
+##############################################################################
+##
+##  A violation store is a directory holding a forms x constraints violation
+##  matrix in compressed sparse column form, as the numpy arrays indptr.npy,
+##  indices.npy, data.npy and shape.npy, together with constraints.txt, which
+##  lists the constraint string of each column. The arrays are memory-mapped
+##  when the store is loaded, so selecting the columns of a few constraints
+##  only reads those columns.
+
+def saveViolations(storeDir, violMat, conStrs):
+    'Writes the violation matrix violMat, with columns conStrs, to storeDir'
+    if not os.path.isdir(storeDir): os.makedirs(storeDir)
+    violMat = violMat.tocsc()
+    violMat.sort_indices()
+    for name, array in [('indptr', violMat.indptr), \
+            ('indices', violMat.indices), ('data', violMat.data), \
+            ('shape', scipy.array(violMat.shape))]:
+        numpy.save(os.path.join(storeDir, name+'.npy'), array)
+    with open(os.path.join(storeDir, 'constraints.txt'), 'w') as fout:
+        for conStr in conStrs:
+            print >> fout, conStr
+
+def loadViolations(storeDir, mmapMode='r'):
+    """Returns the violation matrix in storeDir as a csc_matrix over
+    memory-mapped arrays, and the list of its constraint strings"""
+    arrays = dict((name, numpy.load(os.path.join(storeDir, name+'.npy'), \
+                        mmap_mode=mmapMode)) \
+                  for name in ['indptr', 'indices', 'data'])
+    shape = tuple(numpy.load(os.path.join(storeDir, 'shape.npy')))
+    violMat = scipy.sparse.csc_matrix((arrays['data'], arrays['indices'], \
+                arrays['indptr']), shape=shape, copy=False)
+    with open(os.path.join(storeDir, 'constraints.txt')) as fin:
+        conStrs = [line.rstrip('\n') for line in fin]
+    return(violMat, conStrs)
+
+def writeViolationsText(violFile, violMat):
+    """Exports violMat in the text format of violations.txt, one
+    'form<tab>constraint<tab>violations' line per nonzero cell, by constraint"""
+    violMat = violMat.tocsc()
+    with open(violFile, 'w') as fViol:
+        for jCon in range(violMat.shape[1]):
+            start, end = violMat.indptr[jCon], violMat.indptr[jCon+1]
+            for iWord, nViols in zip(violMat.indices[start:end], \
+                                     violMat.data[start:end]):
+                fViol.write('%d\t%d\t%d\n' %(iWord,jCon,nViols))
+
+class LexiconSampler:
+    """
+    Draws words exactly from the MaxEnt distribution that a Grammar of
+    n-gram constraints defines over the strings of 1 to maxLen segments,
+    P(word) proportional to exp(harmony), without enumerating them.
+
+    With n-gram constraints of length at most K, the violations incurred
+    by appending a segment depend only on the last K-1 segments and on
+    whether the string is still shorter than K+1 segments, and, for the
+    constraints whose matches can overlap, on how recently their last
+    match ended, as a match is not counted again until it has (see
+    ngramViolations). The grammar is thus a weighted automaton over such
+    states. Each transition appends a segment and then either continues
+    or stops, in which case the '$'-anchored constraints are also
+    applied. A backward pass sums the weights of all completions from each
+    state at each length; words are then drawn left to right in
+    proportion to those sums. The sums are rescaled at every length so
+    that long maximum lengths cannot overflow.
+    """
+
+    def __init__(self, grammar, feats, maxLen):
+        self.constraints = grammar.constraints
+        self.weights = grammar.weights
+        self.maxLen = maxLen
+        prefixCons, finalCons, others = splitNgramCons(feats, self.constraints)
+        if others:
+            raise ValueError, 'LexiconSampler can only compile n-gram ' + \
+                    'constraints, not %s' %self.constraints[others[0]]
+        K = max([n for (jCon, initial, n, classes) in prefixCons+finalCons] \
+                or [1])
+        overlapLen = dict([(jCon, n) for (jCon, initial, n, classes) in \
+                prefixCons if selfOverlaps((initial, n, False), classes)])
+
+        ## states are (min(length,K+1), last K-1 segments, blocked), where
+        ## blocked pairs each constraint that cannot yet match again with
+        ## the number of segments appended since its last match ended;
+        ## transitions[s] lists (seg, next state, prefix violations, final
+        ## violations, weight of continuing, weight of stopping)
+        start = (0, (), ())
+        self.stateIndex = {start: 0}
+        self.transitions = []
+        agenda = [start]
+        while agenda:
+            (length, tail, blocked) = agenda.pop(0)
+            blocked = dict(blocked)
+            arcs = []
+            for seg in feats.segments:
+                ngram = tail + (seg,)
+                nextLength = min(length+1, K+1)
+                nextBlocked = dict([(jCon, age+1) for (jCon, age) in \
+                        blocked.items() if age+1 < overlapLen[jCon]-1])
+                viols = []
+                for jCon in violatedCons(prefixCons, nextLength, ngram):
+                    if jCon in overlapLen:
+                        if jCon in blocked: continue
+                        nextBlocked[jCon] = 0
+                    viols.append(jCon)
+                finalViols = violatedCons(finalCons, nextLength, ngram)
+                nextState = (nextLength, ngram[len(ngram)-(K-1):] if K > 1 \
+                        else (), tuple(sorted(nextBlocked.items())))
+                if nextState not in self.stateIndex:
+                    self.stateIndex[nextState] = len(self.stateIndex)
+                    agenda.append(nextState)
+                contWt = math.exp(sum(self.weights[jCon] for jCon in viols))
+                stopWt = contWt * \
+                        math.exp(sum(self.weights[jCon] for jCon in finalViols))
+                arcs.append((seg, self.stateIndex[nextState], viols, \
+                             finalViols, contWt, stopWt))
+            self.transitions.append(arcs)
+
+        ## backward[d][s]: weight of all continuations of a prefix of length
+        ## d in state s, divided by exp(logScale[d])
+        nStates = len(self.transitions)
+        self.backward = [[0.0]*nStates for d in range(maxLen+1)]
+        self.logScale = [0.0]*(maxLen+1)
+        for d in range(maxLen-1, -1, -1):
+            stopScale = math.exp(-self.logScale[d+1])
+            nextBackward = self.backward[d+1]
+            for s, arcs in enumerate(self.transitions):
+                self.backward[d][s] = sum(stopWt*stopScale + \
+                        contWt*nextBackward[nextState] for (seg, nextState, \
+                        viols, finalViols, contWt, stopWt) in arcs)
+            norm = max(self.backward[d])
+            if norm > 0:
+                self.backward[d] = [b/norm for b in self.backward[d]]
+                self.logScale[d] = self.logScale[d+1] + math.log(norm)
+        if self.backward[0][0] == 0:
+            raise ValueError, 'Grammar gives no string any probability'
+        self.cumulative = {}
+
+    def choices(self, d, s):
+        """Cumulative weights of the 2*len(segments) ways to go on from a
+        prefix of length d in state s: append segment i and stop (2*i),
+        or append it and continue (2*i+1)"""
+        try: return(self.cumulative[(d, s)])
+        except KeyError: pass
+        stopScale = math.exp(-self.logScale[d+1])
+        cumWts, total = [], 0.0
+        for (seg, nextState, viols, finalViols, contWt, stopWt) in \
+                self.transitions[s]:
+            total += stopWt*stopScale
+            cumWts.append(total)
+            total += contWt*self.backward[d+1][nextState]
+            cumWts.append(total)
+        self.cumulative[(d, s)] = cumWts
+        return(cumWts)
+
+    def sampleViolations(self):
+        'Draws a word, returning it and its violation counts'
+        counts = [0]*len(self.constraints)
+        segs, d, s = [], 0, 0
+        while True:
+            cumWts = self.choices(d, s)
+            iChoice = bisect.bisect_right(cumWts, random.random()*cumWts[-1])
+            iChoice = min(iChoice, len(cumWts)-1)
+            (seg, nextState, viols, finalViols, contWt, stopWt) = \
+                    self.transitions[s][iChoice//2]
+            segs.append(seg)
+            for jCon in viols: counts[jCon] += 1
+            if iChoice % 2 == 0:
+                for jCon in finalViols: counts[jCon] += 1
+                return(' '.join(segs), counts)
+            d, s = d+1, nextState
+
+    def sample(self, floor=None):
+        """Draws a word as a string of space-separated segments. Words with
+        harmony <= floor are rejected and drawn again."""
+        while True:
+            word, counts = self.sampleViolations()
+            if floor is None: return(word)
+            H = 0.0
+            for jCon, nViols in enumerate(counts):
+                H += self.weights[jCon]*nViols
+            if H > floor: return(word)
+
+def discriminativity(violMat, nTypes):
+    """Average violations per contrast item (rows nTypes and up) minus
+    average violations per training item, for each column of violMat"""
+    nForms = violMat.shape[0]
+    trnViols = scipy.asarray(violMat[:nTypes].sum(0), dtype=float)[0,:]
+    altViols = scipy.asarray(violMat[nTypes:].sum(0), dtype=float)[0,:]
+    return(altViols/(nForms-nTypes) - trnViols/nTypes)
+
 ##############################################################################
 ##  OPTIMIZATION
 ##############################################################################
 
+class Objective:
+    """
+    The negative log posterior of the weights of a MaxEnt grammar and its
+    gradient, for scipy.optimize.fmin_l_bfgs_b. Everything that does not
+    depend on the weights is computed once: the observed violation counts
+    O, and the violation matrix in CSR form together with its transpose,
+    so that each call costs two sparse matrix-vector products. log Z is
+    computed with the log-sum-exp trick, so large harmonies cannot
+    overflow exp.
+
+    Logging is opt-in: with logEvery=k, the objective, weights and
+    gradient are written to stderr on every k-th call.
+    """
+
+    def __init__(self, violMat, trainCts, l1_mult=1.0, l2_mult=None, logEvery=0):
+        self.violMat = scipy.sparse.csr_matrix(violMat, dtype=float)
+        self.violMatT = self.violMat.T.tocsr()
+        self.trainCts = scipy.asarray(trainCts, dtype=float)
+        self.nTrain = self.trainCts.sum()
+        self.O = self.violMatT.dot(self.trainCts)
+        self.l1 = l1_mult or 0.0
+        self.l2 = l2_mult or 0.0
+        self.logEvery = logEvery
+        self.nCalls = 0
+
+    def addConstraints(self, violMatT):
+        """Appends constraints to the grammar, given as the rows of a
+        constraints x forms violation matrix violMatT, so that a growing
+        grammar does not have to rebuild its matrices from scratch"""
+        violMatT = scipy.sparse.csr_matrix(violMatT, dtype=float)
+        self.violMatT = scipy.sparse.vstack([self.violMatT, violMatT], \
+                                            format='csr')
+        self.violMat = self.violMatT.T.tocsr()
+        self.O = scipy.concatenate((self.O, violMatT.dot(self.trainCts)))
+
+    def __call__(self, wts, log=False):
+        logPrior = self.l1*wts.sum() - self.l2*wts.dot(wts)
+        delPrior = self.l1 - 2*self.l2*wts
+
+        H = self.violMat.dot(wts)
+        Hmax = H.max()
+        logPrForms = H - (Hmax + math.log(scipy.exp(H-Hmax).sum()))
+        logData = self.trainCts.dot(logPrForms)
+        E = self.violMatT.dot(self.nTrain*scipy.exp(logPrForms))
+        delData = self.O - E
+
+        self.nCalls += 1
+        if log or (self.logEvery and self.nCalls % self.logEvery == 0):
+            self.report(logPrior+logData, wts, delPrior+delData)
+        return(-logPrior-logData, -delPrior-delData)
+
+    def report(self, logLik, wts, delLik):
+        def brief(vec):
+            if len(vec) <= 3: return(' '.join(['[']+[str(x) for x in vec]+[']']))
+            return(' '.join(['[',str(vec[0]),str(vec[1]),'...',str(vec[-1]),']']))
+        print >> sys.stderr, 'obj:%f' %logLik
+        print >> sys.stderr, 'weights:\t\t%s' %brief(wts)
+        print >> sys.stderr, 'grad:\t%s' %brief(delLik)
+
 def objective(wts, violMat, trainCts, l1_mult=1.0, l2_mult=None, verbose=False):
-    nRows, nCols = violMat.shape
-    if verbose:
-        print >> sys.stderr, 'objective called for %dx%d violMatrix' \
-                             %(nRows,nCols)
-        print >> sys.stderr, 'wts:\t'+str(wts)
-    l1=l1_mult or 0.0
-    l2=l2_mult or 0.0
-    logPrior = l1*sum(wts) - l2*sum(wts*wts)
-    delPrior = l1*scipy.ones(len(wts)) - 2*l2*wts
-
-    if verbose: print >> sys.stderr, 'violMat:\n'+str(violMat.todense())
-    H = violMat.dot(wts)
-    if verbose: print >> sys.stderr, 'H:\t'+str(H)
-
-    cts = scipy.sparse.diags([trainCts],offsets=[0], \
-                shape=(nRows,nRows), format='csr',dtype=int)
-    if verbose: print >> sys.stderr, 'cts:\n' + str(cts.todense())
-    O = scipy.asarray((cts*violMat).sum(0))[0,:]
-    if verbose: print >> sys.stderr, 'O:\t'+str(O)
-    expH = scipy.exp(H)
-    if verbose: print >> sys.stderr, 'expH:\t'+str(expH)
-    Z = sum(expH)
-    if verbose: print >> sys.stderr, 'Z:\t'+str(Z)
-    logPrForms = H-math.log(Z)
-    if verbose: print >> sys.stderr, 'logPrForms:\t'+str(logPrForms)
-    logData = sum(cts.dot(logPrForms))
-
-    if verbose: print >> sys.stderr, ''
-
-    cts = scipy.sparse.diags([sum(trainCts)*scipy.exp(logPrForms)], \
-                offsets=[0], shape=(nRows,nRows), format='csr',dtype=float)
-    if verbose: print >> sys.stderr, 'cts:\n' + str(cts.todense())
-    E = scipy.asarray((cts*violMat).sum(0))[0,:]
-    if verbose: print >> sys.stderr, 'E:\t' + str(E)
-
-    if verbose: print >> sys.stderr, 'logDat:\t' + str(logData)    
-    if verbose: print >> sys.stderr, 'logPr:\t' + str(logPrior)
-    delData = O-E
-    if verbose: print >> sys.stderr, 'logDel:\t' + str(delData)
-    if verbose: print >> sys.stderr, 'delPr:\t' + str(delPrior)
-    if verbose: print >> sys.stderr, ''
-    logLik = logPrior+logData
-    delLik = delPrior+delData
-    print >> sys.stderr, 'obj:%f' %logLik
-    print >> sys.stderr, 'weights:\t\t%s' %' '.join( \
-        ['[',str(wts[0]),str(wts[1]),'...',str(wts[-1]),']'])
-    print >> sys.stderr, 'grad:\t%s' %'  '.join( \
-        ['[',str(delLik[0]),str(delLik[1]),'...',str(delLik[-1]),']'])
-    
-    return(-logPrior-logData, -delPrior-delData)
+    """One-off evaluation of the objective, logged as before; repeated
+    evaluations should build an Objective once and call that instead"""
+    return(Objective(violMat, trainCts, l1_mult, l2_mult)(wts, log=True))
+
+def selectIncrementally(violMat, trainCts, batchSize=10, maxCons=None, \
+                        minGain=0.001, l1_mult=1.0, l2_mult=None, \
+                        factr=10000000, logEvery=0):
+    """
+    Grows a grammar out of the candidate constraints in the columns of
+    violMat, in the spirit of Hayes & Wilson (2008), and returns the
+    selected columns, their weights, and the number of fits.
 
+    Weights are bounded above by 0, so a constraint that is not in the
+    grammar can only lower the objective if the objective's gradient at
+    its zero weight is positive, i.e. if the current grammar expects more
+    violations of it than are observed, by more than the L1 penalty. Each
+    round adds the batchSize candidates with the largest positive
+    gradients and refits, starting from the previous weights (and 0 for
+    the new ones). The grammar being fit is a single Objective: each round
+    takes the batch's rows of the candidates' transposed CSR matrix and
+    appends them with Objective.addConstraints, which transposes the
+    grown matrix back to forms x constraints. Selection stops when no candidate has a positive gradient, when
+    maxCons constraints are selected, or when a round lowers the
+    objective by less than the fraction minGain.
+    """
+    poolObj = Objective(violMat, trainCts, l1_mult, l2_mult)
+    nCands = poolObj.violMat.shape[1]
+    maxCons = min(maxCons or nCands, nCands)
+    poolWts = scipy.zeros(nCands)
+    selected, wts, nFits = [], scipy.zeros(0), 0
+    fitObj = Objective(scipy.sparse.csr_matrix((len(poolObj.trainCts), 0)), \
+                       trainCts, l1_mult, l2_mult, logEvery)
+    fObj, grad = poolObj(poolWts)
+    while len(selected) < maxCons:
+        grad[selected] = -scipy.inf
+        batch = [jCol for jCol in scipy.argsort(-grad, kind='mergesort') \
+                    [:min(batchSize, maxCons-len(selected))] if grad[jCol] > 0]
+        if not batch: break
+        selected += batch
+        fitObj.addConstraints(poolObj.violMatT[batch])
+        nCalls = fitObj.nCalls
+        wts, fNew, info = scipy.optimize.fmin_l_bfgs_b(fitObj, \
+                scipy.concatenate((wts, scipy.zeros(len(batch)))), \
+                bounds=[(-25,0)]*len(selected), factr=factr)
+        nFits += 1
+        print >> sys.stderr, '%d constraints: obj %f after %d evaluations' \
+                %(len(selected), fNew, fitObj.nCalls-nCalls)
+        gain, fObj = fObj - fNew, fNew
+        if gain < minGain*abs(fObj + gain): break
+        poolWts[selected] = wts
+        fObj, grad = poolObj(poolWts)
+    return(selected, wts, nFits)
@@ -1,5 +1,7 @@
 # writes to stdout, allowing us to compress the output directly using gzip
 # python <args> | gzip > output.gz
+# or, compressing in-process and scoring in 16 worker processes,
+# python <args> -z 6 -j 16 > output.gz
 
 ##############################################################################
 ##  Import statements and helper functions                                  ##
@@ -8,6 +10,7 @@
 import argparse
 import os, sys, time, random
 import re
+import gzip, itertools, multiprocessing
 import scipy, scipy.sparse, scipy.optimize
 from maxent import *
 
@@ -75,8 +78,10 @@ parser.add_argument('-c', '--constraints', help='File listing constraints to con
 parser.add_argument('-e', '--enumerate', action='store_true', help='Enumerate constraints from scratch (see docs)')
 
 ## one of the following must be supplied to get violation counts
-parser.add_argument('-v', '--violations', help='File listing nonzero constraint violations in COO format')
+parser.add_argument('-v', '--violations', help='Violation store directory written by --evaluate, or file listing nonzero constraint violations in COO format')
 parser.add_argument('-E', '--evaluate', action='store_true', help='Evaluate constraints on training and contrast set')
+parser.add_argument('--violationsText', action='store_true', help='Also export evaluated violations to violations.txt in COO format')
+parser.add_argument('-N', '--ngramIndex', action='store_true', help='Evaluate n-gram constraints with a segment n-gram index (see maxent.py)')
 
 ## to fill activeCons, need either -d or -s
 parser.add_argument('-d', '--discriminativity', help='File listing discriminativity scores for each constraint')
@@ -85,17 +90,26 @@ parser.add_argument('-s', '--score', action='store_true', help='Calculate discri
 ## the following control how many constraints are put into activeCons
 parser.add_argument('-M', '--maxCons', type=int, help='Maximum number of constraints (recommended: 100)')
 parser.add_argument('--discrimThresh', type=float, default=0.0, help='Ignore constraints below this discriminativity')
+parser.add_argument('-I', '--incremental', action='store_true', help='Select up to --maxCons of these constraints in batches while fitting weights (see selectIncrementally in maxent.py)')
+parser.add_argument('--batchSize', type=int, default=10, help='Number of constraints added per round of --incremental')
+parser.add_argument('--minGain', type=float, default=0.001, help='Stop --incremental once a round lowers the objective by less than this fraction')
 
 ## the following are parameters for the weight-setting step
 parser.add_argument('-l', '--L1', type=float, default=1.0, help='Multiplier for L1 regularizer')
 parser.add_argument('-L', '--L2', type=float, default=None, help='Multiplier for L1 regularizer')
 parser.add_argument('-p', '--precision', type=float, default=10000000, help='Precision for gradient search (see docs)')
+parser.add_argument('--logEvery', type=int, default=0, metavar='K', help='Log the objective on every K-th evaluation (default: never)')
 
 ## alternatively, one can just load a grammar directly
 parser.add_argument('-g', '--grammar', help='File listing active constraints and weights to load directly')
 
-## and finally, the test file
+## and finally, the test file, or the length up to which to test all strings
 parser.add_argument('-T', '--test', help='File listing test items')
+parser.add_argument('--enumerateTest', type=int, metavar='MAXLEN', help='Test all strings of 1 to MAXLEN segments, in make_pakna.py order, instead of a test file')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes generating the contrast set and scoring the test forms')
+parser.add_argument('--chunkSize', type=int, default=10000, help='Approximate number of test forms scored at a time')
+parser.add_argument('-z', '--gzipLevel', type=int, choices=range(10), metavar='LEVEL', help='gzip the test output in-process at this compression level, from 1 (fastest) to 9 (smallest); 0 writes the gzip format without compressing')
+parser.add_argument('--minHarmony', type=float, metavar='FLOOR', help='Do not output test forms with harmony <= FLOOR; with --enumerateTest, also prune their prefixes (needs non-positive weights)')
 #parser.add_argument('-o', '--output', help='Testing output')
 
 args = parser.parse_args()
@@ -190,7 +204,7 @@ elif args.trainCounts:
             
     status('Generating unobserved string edit neighbors as contrast set')
     wordOrder = sorted(trainCts.keys())
-    badNbs = badNeighbors(trainCts, feats.segments)
+    badNbs = badNeighbors(trainCts, feats.segments, args.jobs)
     randVec = scipy.rand(len(badNbs))
     for iNb, randNum in enumerate(randVec):
         if randNum < 0.5:
@@ -296,24 +310,39 @@ print >> sys.stderr, ''
 ############################################################################
 ## STEP 2: Get constraint violations                                      ##
 ############################################################################
+##                                                                        ##
+##  allViols <scipy.sparse.csc_matrix> -- violations of every constraint  ##
+##      in conOrder, or None if they are only available as a text file    ##
+##                                                                        ##
+############################################################################
 print >> sys.stderr, '**** Ensuring that violations file is accessible ****'
+allViols = None
 
 ## in the worst case, have to evaluate constraints
 if args.evaluate:
-    violFile = os.path.join(args.workingDir, 'violations.txt')
+    violStore = os.path.join(args.workingDir, 'violations')
     status('No violations file supplied, evaluating and storing to %s' \
-           %violFile)
+           %violStore)
     print >> sys.stderr, 'This step may take a lot of time. Constraint stats'+\
                          ' shown to report progress.'
 ##    status('discriminativity\tconstraint string')
-    with open(violFile, 'w') as fViol:
+    if args.ngramIndex:
+        status('Tokenising forms into segment n-grams')
+        allViols = ngramViolations(registry, conOrder, wordOrder)
+        discrims = discriminativity(allViols, nTypes)
+        for jCon in range(len(conOrder)):
+            discrimDic[jCon] = float(discrims[jCon])
+    else:
+        rowVec, colVec, valVec = [], [], []
         for jCon,conStr in enumerate(conOrder):
             trnViols, altViols = 0, 0
             con = registry.interpret(conStr)
             for iWord,word in enumerate(wordOrder):
                 nViols = con(word)
                 if nViols:
-                    fViol.write('%d\t%d\t%d\n' %(iWord,jCon,nViols))
+                    rowVec.append(iWord)
+                    colVec.append(jCon)
+                    valVec.append(nViols)
                     if iWord >= nTypes: altViols += nViols
                     else: trnViols += nViols
             ## discriminativity = avg. violations per contrast item, minus
@@ -322,7 +351,15 @@ if args.evaluate:
             discrimDic[jCon] = discrim
             
 ##            status('%1.6f\t%s' %(discrim, conStr))
+        allViols = scipy.sparse.coo_matrix((valVec, (rowVec, colVec)), \
+                    shape=(len(wordOrder), len(conOrder)), dtype=int).tocsc()
+        rowVec, colVec, valVec = None, None, None
     status('done evaluating!!')
+    saveViolations(violStore, allViols, conOrder)
+    if args.violationsText:
+        violFile = os.path.join(args.workingDir, 'violations.txt')
+        status('Exporting violations to %s' %violFile)
+        writeViolationsText(violFile, allViols)
     
     discrimFile = os.path.join(args.workingDir, 'discriminativity.txt')
     status('Writing constraint discriminativities to %s' %discrimFile)
@@ -331,6 +368,23 @@ if args.evaluate:
             print >> fDiscrim, '%s\t%f' %(conStr, discrimDic[jCon])
 
 ##  but if the were compiled already, use the stored file
+elif args.violations and os.path.isdir(args.violations):
+    status('Memory-mapping the violations stored in %s' %args.violations)
+    allViols, storedCons = loadViolations(args.violations)
+    if storedCons != conOrder:
+        ## the store's columns are matched to conOrder by constraint string
+        storedIndex = {}
+        for jStored, conStr in enumerate(storedCons):
+            storedIndex.setdefault(conStr, jStored)
+        missing = [conStr for conStr in conOrder if conStr not in storedIndex]
+        if missing:
+            print >> sys.stderr, '%d of the constraints loaded ' %len(missing) + \
+                    'are not in %s, e.g. %s' %(args.violations, missing[0])
+            print >> sys.stderr, 'Please evaluate them again with --evaluate.'
+            sys.exit(1)
+        status('Reordering the stored violations to match the constraints loaded')
+        allViols = allViols[:,[storedIndex[conStr] for conStr in conOrder]]
+
 elif args.violations:
     violFile = args.violations
     status('You have indicated violations are stored in %s' %violFile)
@@ -356,6 +410,19 @@ elif args.discriminativity:
             conStr, discrim = line.rstrip().split('\t')
             discrimDic[conOrder.index(conStr)] = float(discrim)
 
+elif args.score and allViols is not None:
+    status('Calculating constraint discriminativity from stored violations')
+    discrims = discriminativity(allViols, nTypes)
+    ## as with a violations file, only constraints with violations are scored
+    for jCon in scipy.flatnonzero(scipy.diff(allViols.indptr)):
+        discrimDic[jCon] = float(discrims[jCon])
+
+    discrimFile = os.path.join(args.workingDir, 'discriminativity.txt')
+    status('Writing constraint discriminativities to %s' %discrimFile)
+    with open(discrimFile,'w') as fDiscrim:
+        for jCon,conStr in enumerate(conOrder):
+            print >> fDiscrim, '%s\t%f' %(conStr, discrimDic.get(jCon,0.0))
+
 elif args.score:
     status('Calculating constraint discriminativity from violations file')
     print >> sys.stderr, 'Since the violations file may not be stored' + \
@@ -370,7 +437,7 @@ elif args.score:
         for line in fin:
             iWord, jCon, nViols = [int(x) for x in line.split()]
             discrimDic[jCon] = 0.0
-            if iWord >= nObserved:
+            if iWord >= nTypes:
                 altViols[jCon] = altViols.get(jCon,0) + nViols
             else:
                 trnViols[jCon] = trnViols.get(jCon,0) + nViols
@@ -380,10 +447,10 @@ elif args.score:
         discrimDic[jCon] = altViolsPerWord - trnViolsPerWord
 
     discrimFile = os.path.join(args.workingDir, 'discriminativity.txt')
-    status('Writing constraint discriminativities to %s')
+    status('Writing constraint discriminativities to %s' %discrimFile)
     with open(discrimFile,'w') as fDiscrim:
         for jCon,conStr in enumerate(conOrder):
-            print >> fDiscrim, '%s\t%f' %(conStr, discrimDic[jCon])
+            print >> fDiscrim, '%s\t%f' %(conStr, discrimDic.get(jCon,0.0))
 else:
     print >> sys.stderr, 'WARNING: No constraint discriminativities to get'
 print >> sys.stderr, ''
@@ -400,15 +467,21 @@ if discrimDic:
                     if discrimDic[jCon] > discrimThresh]
     ## arrange constraints in decreasing order of discriminativity
     activeCons.sort(key = discrimDic.get, reverse=True)
-    ## dump less-discriminative constraints so as not to exceeed maxCons
-    if len(activeCons) > args.maxCons: activeCons = activeCons[:args.maxCons]
-    status('Selected %d active constraints' %len(activeCons))
-    
     activeConsFile = os.path.join(args.workingDir, 'active_constraints.txt')
-    status('Writing active constraints to %s' %activeConsFile)
-    with open(activeConsFile, 'w') as fout:
-        for jCon in activeCons:
-            print >> fout, conOrder[jCon]
+    if args.incremental:
+        ## all of them are candidates; maxCons applies to the selection
+        status('Kept %d candidate constraints for incremental selection' \
+               %len(activeCons))
+    else:
+        ## dump less-discriminative constraints so as not to exceeed maxCons
+        if len(activeCons) > args.maxCons:
+            activeCons = activeCons[:args.maxCons]
+        status('Selected %d active constraints' %len(activeCons))
+    
+        status('Writing active constraints to %s' %activeConsFile)
+        with open(activeConsFile, 'w') as fout:
+            for jCon in activeCons:
+                print >> fout, conOrder[jCon]
 else:
     print >> sys.stderr, 'WARNING: No constraints to select'
 print >> sys.stderr, ''
@@ -418,16 +491,20 @@ print >> sys.stderr, ''
 ############################################################################
 
 print >> sys.stderr, '**** Reading sparse violation matrix in from file ****'
-if activeCons:
+if activeCons and allViols is not None:
+    status('Slicing the active constraints out of the stored violations')
+    nRows, nCols = len(wordOrder), len(activeCons)
+    violMat = allViols[:,activeCons].tocsr()
+    status('Sparse violations matrix added to memory!')
+
+elif activeCons:
     status('Creating sparseIndex dict for fast constraint checking')
     status('(keys = raw index; values = col index in sparse matrix)')
     sparseIndex = {}
     for colIndex,jCon in enumerate(activeCons):
         sparseIndex[jCon] = colIndex
     
-    status('Initializing violations matrix')
     nRows, nCols = len(wordOrder), len(sparseIndex)
-    violMat = scipy.sparse.csr_matrix((nRows, nCols), dtype=int)
     status('Commencing read-in. A "." will be displayed for every 100,000')
     status('\tviolations added to the violation matrix.')
     
@@ -439,20 +516,11 @@ if activeCons:
                 rowVec.append(iWord)
                 colVec.append(sparseIndex[jCon])
                 valVec.append(nViols)
-                
-                ## every 10,000 appends, COO -> CSR -> violMat
-                if (len(rowVec) % 100000 == 0) and len(rowVec):
-                    print >> sys.stderr, '.',
-                    tempMat = scipy.sparse.coo_matrix((scipy.array(valVec), \
-                                (scipy.array(rowVec), scipy.array(colVec))), \
-                                shape=(nRows, nCols), dtype=int)
-                    violMat = violMat + tempMat.tocsr()
-                    rowVec, colVec, valVec, tempMat = [], [], [], None
-        ## add any remaining nonzero counts
-        tempMat = scipy.sparse.coo_matrix((scipy.array(valVec), \
+                if len(rowVec) % 100000 == 0: print >> sys.stderr, '.',
+        ## a single COO -> CSR conversion at the end
+        violMat = scipy.sparse.coo_matrix((scipy.array(valVec), \
                     (scipy.array(rowVec), scipy.array(colVec))), \
-                    shape=(nRows, nCols), dtype=int)
-        violMat = violMat + tempMat.tocsr()
+                    shape=(nRows, nCols), dtype=int).tocsr()
         print >> sys.stderr, ''
     status('Sparse violations matrix added to memory!')
     
@@ -474,13 +542,31 @@ if activeCons:
     prec = args.precision
     negReals = [(-25,0) for wt in range(nCols)]
 
-    status('Optimizing objective function with scipy.optimize.fmin_l_bfgs_b')
-    status('This may take some time')
-    conWts, nfeval, returnCode = scipy.optimize.fmin_l_bfgs_b(objective, \
-            -scipy.array([discrimDic[jCon] for jCon in activeCons]), \
-            args = (violMat,wordCts,l1_mult,l2_mult), \
-            bounds=negReals, factr=args.precision)
-    status('done!')
+    if args.incremental:
+        status('Selecting constraints %d at a time while fitting weights' \
+               %args.batchSize)
+        selected, conWts, nFits = selectIncrementally(violMat, wordCts, \
+                args.batchSize, args.maxCons, args.minGain, l1_mult, l2_mult, \
+                args.precision, args.logEvery)
+        status('done after %d fits!' %nFits)
+        activeCons = [activeCons[jCol] for jCol in selected]
+        violMat = violMat[:,selected]
+        objFn = Objective(violMat, wordCts, l1_mult, l2_mult)
+        status('Selected %d active constraints' %len(activeCons))
+
+        status('Writing active constraints to %s' %activeConsFile)
+        with open(activeConsFile, 'w') as fout:
+            for jCon in activeCons:
+                print >> fout, conOrder[jCon]
+    else:
+        objFn = Objective(violMat, wordCts, l1_mult, l2_mult, args.logEvery)
+
+        status('Optimizing objective function with scipy.optimize.fmin_l_bfgs_b')
+        status('This may take some time')
+        conWts, nfeval, returnCode = scipy.optimize.fmin_l_bfgs_b(objFn, \
+                -scipy.array([discrimDic[jCon] for jCon in activeCons]), \
+                bounds=negReals, factr=args.precision)
+        status('done after %d evaluations!' %objFn.nCalls)
 
     ## save final grammar
     gramFile = os.path.join(args.workingDir,'grammar.txt')
@@ -491,7 +577,7 @@ if activeCons:
 
     status('Outputting calculation for trained max')
     print >> sys.stderr, 'Running objective function for trained max'
-    fMax, grad = objective(conWts, violMat, wordCts, l1_mult, l2_mult)
+    fMax, grad = objFn(conWts, log=True)
 
 print >> sys.stderr, ''
 
@@ -516,7 +602,7 @@ if args.grammar:
 
 print >> sys.stderr, '**** Testing codeblock ****'
 
-if args.test:
+if args.test or args.enumerateTest:
     status('Getting constraints')
     cons = []
     for jCol, jCon in enumerate(activeCons):
@@ -524,19 +610,64 @@ if args.test:
         cons.append(registry.interpret(conStr))
 
     
-    status('Writing test results to stdout')
-    fout = sys.stdout
-    with open(args.test) as fin:
-        for line in fin:
-            parse = line.rstrip().split('\t')
-            testForm = parse[0]
-            fout.write(testForm)
-            H = 0.0
-            for jCol,con in enumerate(cons):
-                nViols = con(testForm)
-                fout.write('\t%d' %nViols)
-                H += conWts[jCol]*nViols
-            fout.write('\t%f\n' %H)
+    activeConStrs = [conOrder[jCon] for jCon in activeCons]
+
+    ## The test forms are scored in chunks, which are either the lines of
+    ## the test file or the enumerated strings with a given prefix. With
+    ## --jobs > 1 the chunks are scored by a pool of worker processes (which
+    ## inherit the grammar when they are forked), and the scored chunks are
+    ## written in their original order.
+    def testChunks():
+        'Yields the chunks of test forms to be scored'
+        if args.enumerateTest:
+            status('Enumerating test strings of up to %d segments' \
+                   %args.enumerateTest)
+            nSegs = len(feats.segments)
+            for length in range(1, args.enumerateTest+1):
+                ## fix enough of the prefix for a chunk to hold ~chunkSize strings
+                depth = 1
+                while depth < length and nSegs**(length-depth) > args.chunkSize:
+                    depth += 1
+                for root in itertools.product(feats.segments, repeat=depth):
+                    yield (length, root)
+        else:
+            with open(args.test) as fin:
+                while True:
+                    lines = list(itertools.islice(fin, args.chunkSize))
+                    if not lines: break
+                    yield [line.rstrip().split('\t')[0] for line in lines]
+
+    def scoreChunk(chunk):
+        'Returns the test output for a chunk of test forms'
+        if args.enumerateTest:
+            length, root = chunk
+            scored = enumerateViolations(registry, activeConStrs, length, \
+                        conWts, args.minHarmony, minLen=length, root=root)
+        else:
+            scored = ((testForm, [con(testForm) for con in cons]) \
+                        for testForm in chunk)
+        return(''.join(scoreLines(scored, conWts, args.minHarmony)))
+
+    if args.gzipLevel is not None:
+        status('Writing gzipped test results to stdout')
+        fout = gzip.GzipFile(filename='', mode='wb', \
+                             compresslevel=args.gzipLevel, fileobj=sys.stdout)
+    else:
+        status('Writing test results to stdout')
+        fout = sys.stdout
+    if args.jobs > 1:
+        status('Scoring in %d worker processes' %args.jobs)
+        pool = multiprocessing.Pool(args.jobs)
+        scoredChunks = pool.imap(scoreChunk, testChunks())
+    else:
+        scoredChunks = itertools.imap(scoreChunk, testChunks())
+    for scoredChunk in scoredChunks:
+        fout.write(scoredChunk)
+    if args.jobs > 1:
+        pool.close()
+        pool.join()
+    if args.gzipLevel is not None: fout.close()
+    sys.stdout.flush()
     status('Done!')
 
 print >> sys.stderr, ''